@@ -2,65 +2,152 @@
 Illumination correction as proposed by Jones et al. (2006)
 """
 
-from functools import partial
+from functools import partial, lru_cache
 import numpy
 import dask.bag
 import dask.delayed
 from scipy.signal import medfilt2d
 from scipy.ndimage import median_filter
 from pathlib import Path
+import json
 import pickle
 import dask.graph_manipulation
 from skimage.transform import downscale_local_mean, rescale
-import copy
 
+from scip.illumination_correction import histogram_median
+
+MEDIAN_FILTER_MODES = ["exact", "histogram"]
+
+
+# each memory-mapped image holds on to its file, so only the most recently used are kept
+CORRECTION_CACHE_SIZE = 64
+
+
+@lru_cache(maxsize=CORRECTION_CACHE_SIZE)
+def _load_correction_image(path: str, name: str) -> numpy.ndarray:
+    return numpy.load(Path(path) / name, mmap_mode="r")
+
+
+class CorrectionStore:
+    """Correction images stored as one .npy file per group in a directory, together with an
+    index.json file mapping each group to its file. An image is memory-mapped on first access
+    and cached per worker process, so that workers only touch the groups present in their
+    partitions.
+    """
+
+    def __init__(self, path: Path):
+        self.path = str(path)
+        with open(Path(path) / "index.json") as fh:
+            self.files = {group: name for group, name in json.load(fh)}
+
+    def __getitem__(self, group) -> numpy.ndarray:
+        return _load_correction_image(self.path, self.files[group])
+
+
+def save_correction_images(mean_images, output: Path) -> None:
+    """Saves correction images as one .npy file per group, readable by CorrectionStore. Files are
+    numbered, as groups can be any value such as paths, and are mapped to their group in
+    index.json.
+    """
+    (output / "correction_images").mkdir(parents=False, exist_ok=True)
+    index = []
+    for i, (group, image) in enumerate(mean_images.items()):
+        numpy.save(output / "correction_images" / f"{i}.npy", image)
+        index.append((group.item() if isinstance(group, numpy.generic) else group, f"{i}.npy"))
+    with open(output / "correction_images" / "index.json", "w") as fh:
+        json.dump(index, fh)
+
+
+def _downscale(pixels, downscale):
+    if downscale > 1:
+        return downscale_local_mean(pixels, factors=(1, downscale, downscale))
+    return pixels
+
+
+def _binop(total, x, downscale):
+    # images are accumulated at the downscaled resolution, so that the accumulators that are
+    # exchanged between workers are downscale² times smaller
+    pixels = _downscale(x["pixels"], downscale)
 
-def _binop(total, x):
     if total["pixels"] is None:
-        total["pixels"] = numpy.zeros_like(x["pixels"])
+        # the initial accumulator is shared between groups and must not be modified
+        return dict(
+            pixels=pixels.astype(numpy.float32),
+            count=total["count"] + 1,
+            shape=x["pixels"].shape
+        )
 
-    return dict(
-        pixels=total["pixels"] + x["pixels"],
-        count=total["count"] + 1
-    )
+    numpy.add(total["pixels"], pixels, out=total["pixels"], casting="unsafe")
+    total["count"] += 1
+    return total
 
 
 def _combine(total1, total2):
     if total1["pixels"] is None:
-        total1["pixels"] = numpy.zeros_like(total2["pixels"])
+        return total2
+    if total2["pixels"] is None:
+        return total1
 
-    return dict(
-        pixels=total2["pixels"] + total1["pixels"],
-        count=total1["count"] + total2["count"]
-    )
+    numpy.add(total1["pixels"], total2["pixels"], out=total1["pixels"])
+    total1["count"] += total2["count"]
+    return total1
 
 
-def _finish(total, filter_func, downscale):
-    avg = total[1]["pixels"] / total[1]["count"]
+def _partition_totals(part, key, downscale):
+    totals = {}
+    for x in part:
+        totals[x[key]] = _binop(
+            totals.get(x[key], dict(pixels=None, count=0)), x, downscale=downscale)
+    return totals
+
+
+def _merge_totals(totals_list):
+    merged = {}
+    for totals in totals_list:
+        for group, total in totals.items():
+            merged[group] = _combine(merged.get(group, dict(pixels=None, count=0)), total)
+    return merged
 
-    if downscale > 1:
-        # downscale the image prior to median filtering to reduce memory consumption
-        avg = downscale_local_mean(avg, factors=(1, downscale, downscale))
+
+def _finish(totals, group, filter_func, downscale):
+    if group not in totals:
+        return None
+    total = totals[group]
+
+    avg = total["pixels"] / total["count"]
 
     avg = numpy.asarray([
         filter_func(avg[i])
-        for i in range(len(total[1]["pixels"]))
+        for i in range(len(avg))
     ])
     avg = numpy.where(avg == 0, 1, avg)  # swap out 0 for division no-op 1
 
     if downscale > 1:
-        # reverse earlier downscaling
+        # reverse the downscaling, and crop the padding added when the image size is not a
+        # multiple of the downscale factor
         avg = rescale(avg, scale=downscale, anti_aliasing=True, channel_axis=0)
+        shape = total["shape"]
+        avg = avg[:, :shape[1], :shape[2]]
+
+    return avg.astype(numpy.float32)
+
 
-    return (total[0], avg)
+def _finish_group(group, totals, filter_func, downscale):
+    return group, _finish(totals, group, filter_func=filter_func, downscale=downscale)
+
+
+def _collect(pairs):
+    return {g: im for g, im in pairs if im is not None}
 
 
 def correct(
     *,
     images: dask.bag.Bag,
     key: str,
-    ngroups: int,
+    groups: dask.bag.Bag,
     median_filter_size: int = 50,
+    median_filter_mode: str = "exact",
+    median_filter_bins: int = 256,
     downscale: int = 1,
     output: Path = None,
     precomputed: Path = None
@@ -68,7 +155,8 @@ def correct(
     """
     Distributed implementation of retrospective illumination correction [1]. All images
     are averaged per batch, after which the image is filtered using a median filter. If requested,
-    the image is downscaled prior to median filtering to reduce memory consumption.
+    the images are downscaled as they are averaged to reduce memory consumption and the amount
+    of data exchanged between workers.
 
     [1] Singh, S., Bray, M. A., Jones, T. R., & Carpenter, A. E. (2014). Pipeline for illumination
     correction of images for high‐throughput microscopy. Journal of microscopy, 256(3), 231-236.
@@ -77,54 +165,69 @@ def correct(
         images: Collection containing images to be corrected. Each item in the collection a
             pixels and 'key' key.
         key: Item key used for grouping.
-        ngroups: Number of groups in the images collection.
+        groups: Collection of the distinct values of key in the images collection, typically
+            persisted together with the images. The groups are spread over the partitions of the
+            images collection, so that they are finished in parallel. Groups that turn out to be
+            absent from the collection are skipped.
         median_filter_size: Size of the window used in the median filter.
+        median_filter_mode: One of MEDIAN_FILTER_MODES. The histogram mode quantizes the
+            average image in median_filter_bins bins, and runs in time independent of the
+            window size.
+        median_filter_bins: Number of bins used by the histogram mode.
         downscale: factor by which to downscale the image prior to median filtering
-        output: Path pointing to directory to save correction images.
-        precomputed: Path to pickle file with precomputed correction images in a dict.
+        output: Path pointing to directory to save correction images in, as a
+            correction_images directory with one .npy file per group and an index.json file.
+        precomputed: Path to a directory with precomputed correction images, as saved with
+            output. A pickle file with the correction images in a dict is also accepted.
 
     Returns:
         Collection with corrected images.
     """
 
+    if median_filter_mode not in MEDIAN_FILTER_MODES:
+        raise ValueError(f"Median filter mode must be one of {MEDIAN_FILTER_MODES}")
+
+    if median_filter_mode == "histogram":
+        filter_func = partial(
+            histogram_median.median_filter, size=median_filter_size, bins=median_filter_bins)
     # switch to medfilt2d for larger filter sizes as it consumes less memory
-    if median_filter_size > 150:
+    elif median_filter_size > 150:
         filter_func = partial(medfilt2d, kernel_size=median_filter_size)
     else:
         filter_func = partial(median_filter, size=median_filter_size)
 
     def divide(part, mu):
-        newpart = copy.deepcopy(part)
-        for x in newpart:
-            x["pixels"] = x["pixels"] / mu[x[key]]
+        newpart = []
+        for x in part:
+            newx = x.copy()
+            newx["pixels"] = numpy.divide(x["pixels"], mu[x[key]], dtype=numpy.float32)
+            newpart.append(newx)
         return newpart
 
-    if precomputed is not None:
+    if (precomputed is not None) and Path(precomputed).is_dir():
+        mean_images = CorrectionStore(precomputed)
+    elif precomputed is not None:
         @dask.delayed(pure=True)
         def load_images(p):
             with open(p, "rb") as fh:
                 return pickle.load(fh)
         mean_images = load_images(str(precomputed))
     else:
-        mean_images = images.foldby(
-            key=key,
-            binop=_binop,
-            combine=_combine,
-            initial=dict(pixels=None, count=0),
-            combine_initial=dict(pixels=None, count=0)
+        # per group sums are reduced in a tree, after which each group is finished in parallel
+        totals = images.reduction(
+            perpartition=partial(_partition_totals, key=key, downscale=downscale),
+            aggregate=_merge_totals
         )
-        mean_images = mean_images.repartition(npartitions=ngroups)
-        mean_images = mean_images.map(_finish, filter_func=filter_func, downscale=downscale)
-        mean_images = dask.delayed(dict, pure=True)(mean_images)
+        pairs = groups.repartition(npartitions=images.npartitions).map(
+            _finish_group, totals=totals, filter_func=filter_func, downscale=downscale)
+        mean_images = dask.delayed(_collect, pure=True)(pairs)
 
     images = images.map_partitions(divide, mu=mean_images)
 
-    if output is not None:
-        @dask.delayed
-        def save(mean_images):
-            with open(str(output / "correction_images.pickle"), "wb") as fh:
-                pickle.dump(mean_images, fh)
+    # correction images loaded from a store are already on disk
+    if (output is not None) and (not isinstance(mean_images, CorrectionStore)):
+        save = dask.delayed(save_correction_images)
         return dask.graph_manipulation.bind(
-            children=images, parents=save(mean_images), omit=mean_images)
+            children=images, parents=save(mean_images, output), omit=mean_images)
 
     return images
@@ -20,11 +20,16 @@ Data loaders for various image formats. All data loaders take a path as input an
 lazy collection containing all fields of view with meta data.
 """
 
-from typing import List, Mapping, Any, Tuple
+from typing import List, Mapping, Any, Tuple, Optional, Callable, Iterable
 
+import math
+import numpy
+import dask
 import dask.bag
 from pathlib import Path
 
+from scip.utils.util import enforce_dtype_partition
+
 
 def load_meta(
     *,
@@ -37,9 +42,16 @@ def load_meta(
     for path in paths:
         assert Path(path).exists(), f"{path} does not exist."
 
-        meta = loader_module.meta_from_directory(path=path, **kwargs)
-        bag = dask.bag.from_delayed(meta)
-        bags.append(bag)
+        # loaders can split a path in shards that are discovered in parallel
+        if hasattr(loader_module, "get_shards"):
+            shards = loader_module.get_shards(path=path, **kwargs)
+        else:
+            shards = [path]
+
+        for shard in shards:
+            meta = loader_module.meta_from_directory(path=shard, **kwargs)
+            bag = dask.bag.from_delayed(meta)
+            bags.append(bag)
 
     return dask.bag.concat(bags)
 
@@ -48,10 +60,113 @@ def load_pixels(
     *,
     bag: dask.bag.Bag,
     channels: List[int],
+    dtype: str = "native",
+    project: Optional[Callable[[Iterable[numpy.ndarray]], numpy.ndarray]] = None,
     kwargs: Mapping[str, Any] = {},
     loader_module
 ) -> dask.bag.Bag:
 
+    # loaders with STREAMING_PROJECTION fold the Z-stack into the projection while reading
+    if project is not None:
+        assert getattr(loader_module, "STREAMING_PROJECTION", False), \
+            "Loader does not support streaming projection"
+        kwargs = dict(kwargs, project=project)
+
     bag = loader_module.load_pixels(bag, channels=channels, **kwargs)
 
-    return bag
+    return bag.map_partitions(enforce_dtype_partition, dtype=dtype)
+
+
+def auto_npartitions(
+    *,
+    bag: dask.bag.Bag,
+    channels: List[int],
+    budget: int,
+    min_npartitions: int = 1,
+    dtype: str = "native",
+    kwargs: Mapping[str, Any] = {},
+    loader_module
+) -> int:
+    """Computes the number of partitions needed to keep the pixels of each partition within a
+    byte budget, based on the size estimates of the loader.
+
+    Args:
+        bag: Collection of events without pixels.
+        channels: Channels that will be loaded.
+        budget: Target size in bytes of the pixels in one partition.
+        min_npartitions: Lower bound, typically the number of threads in the cluster.
+        dtype: Pixel dtype policy the pixels will be loaded with.
+
+    Returns:
+        Number of partitions.
+    """
+
+    def estimate(partition):
+        return [loader_module.estimate_nbytes(partition, channels, dtype=dtype, **kwargs)]
+
+    nbytes = bag.map_partitions(estimate).sum().compute()
+    return max(math.ceil(nbytes / budget), min_npartitions)
+
+
+def repartition(
+    *,
+    bag: dask.bag.Bag,
+    npartitions: int,
+    loader_module
+) -> dask.bag.Bag:
+
+    if hasattr(loader_module, "repartition"):
+        return loader_module.repartition(bag, npartitions=npartitions)
+
+    return bag.repartition(npartitions=npartitions)
+
+
+def _partition_size(partition):
+    return [len(partition)]
+
+
+@dask.delayed
+def _take(partition, indices):
+    partition = list(partition)
+    return [partition[i] for i in indices]
+
+
+def sample_meta(
+    *,
+    bag: dask.bag.Bag,
+    k: int,
+    with_replacement: bool = False,
+    seed: int = None
+) -> dask.bag.Bag:
+    """Samples events from a collection of events without pixels, so that the pixels of events
+    that are not sampled are never loaded. The partition layout of the collection is kept, as
+    some loaders rely on it, but partitions without sampled events are dropped.
+
+    Args:
+        bag: Collection of events without pixels, preferably persisted.
+        k: Number of events to sample. Without replacement, at most all events are returned.
+        with_replacement: Whether events can be sampled more than once.
+        seed: Seed for the random number generator.
+
+    Returns:
+        Collection of sampled events.
+    """
+
+    sizes = bag.map_partitions(_partition_size).compute()
+    total = sum(sizes)
+    if not with_replacement:
+        k = min(k, total)
+
+    rng = numpy.random.default_rng(seed)
+    indices = numpy.sort(rng.choice(total, size=k, replace=with_replacement))
+    bounds = numpy.cumsum([0] + sizes)
+
+    parts = []
+    for part, start, stop in zip(bag.to_delayed(), bounds[:-1], bounds[1:]):
+        idx = indices[(indices >= start) & (indices < stop)] - start
+        if len(idx) > 0:
+            parts.append(_take(part, idx.tolist()))
+
+    if len(parts) == 0:
+        return dask.bag.from_sequence([], npartitions=1)
+    return dask.bag.from_delayed(parts)
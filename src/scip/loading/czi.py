@@ -21,31 +21,140 @@ dimensions to be present.
 """
 
 import re
-from typing import List, Mapping, Any
+from typing import List, Mapping, Any, Callable, Iterable
+from functools import partial
 
 from aicsimageio import AICSImage
 import dask.bag
 import dask.dataframe
 import dask.array
 import dask
+import numpy
 
 from scip.loading import util as l_util
 
+# Z-stack projection can be fused into loading, see load_pixels
+STREAMING_PROJECTION = True
 
-def _load_block(event, channels):
-    im = AICSImage(event["path"], reconstruct_mosaic=False)
-    im.set_scene(event["scene"])
 
-    newevent = event.copy()
+def _open(path):
+    # The lazy array is chunked per plane instead of per Z-stack (the aicsimageio default), so
+    # that the per-plane reads of a fused projection decode one plane each.
+    return AICSImage(path, reconstruct_mosaic=False, chunk_dims=["Y", "X"])
+
+
+_readers = l_util.ReaderCache(factory=_open)
+
+
+def _read(im, order, **selection):
+    # get_image_data decodes the full scene and keeps it on the reader until the scene changes,
+    # so cached readers would pin decoded scenes. Only the selection is decoded from the lazy
+    # array, which leaves the cached readers holding parsed headers only.
+    return im.get_image_dask_data(order, **selection).compute(scheduler="synchronous")
+
+
+def _read_scene(path, scene, order, **selection):
+    # The scene is decoded in one read on a reader outside of the cache, so that the decoded
+    # scene is dropped together with the reader.
+    im = AICSImage(path, reconstruct_mosaic=False)
+    im.set_scene(scene)
+    return im.get_image_data(order, **selection)
+
 
+def _selection(im, channels, tiles):
+    selection = dict(T=0)
     if channels is not None:
-        newevent["pixels"] = im.get_image_data("CZXY", T=0, C=channels)
-    else:
-        newevent["pixels"] = im.get_image_data("CZXY", T=0)
+        selection["C"] = channels
+    if "M" in im.dims.order:
+        selection["M"] = tiles
+    return selection
+
+
+def _load_block(event, channels, reader_cache_size, project=None):
+    im, lock = _readers.get(str(event["path"]), capacity=reader_cache_size)
+
+    newevent = event.copy()
+
+    with lock:
+        im.set_scene(event["scene"])
+        selection = _selection(im, channels, event["tile"])
+        if project is None:
+            newevent["pixels"] = _read(im, "CZXY", **selection)
+        else:
+            newevent["pixels"] = project(
+                _read(im, "CXY", Z=z, **selection) for z in range(im.dims.Z))
 
     return newevent
 
 
+def _load_scene_partition(partition, channels, reader_cache_size, project=None):
+    """Loads all tiles of a scene present in the partition with one read, and slices the
+    tiles out of the result. If project is set, the read is done one Z plane at a time.
+    """
+
+    scenes = {}
+    for i, event in enumerate(partition):
+        scenes.setdefault((str(event["path"]), event["scene"]), []).append(i)
+
+    newpartition = [None] * len(partition)
+    for (path, scene), positions in scenes.items():
+        im, lock = _readers.get(path, capacity=reader_cache_size)
+        tiles = sorted(set(partition[i]["tile"] for i in positions))
+
+        with lock:
+            im.set_scene(scene)
+            if "M" in im.dims.order:
+                order, selection = "MCZXY", _selection(im, channels, tiles)
+            else:
+                order, selection = "CZXY", _selection(im, channels, None)
+                tiles = [0]
+
+            if project is None:
+                data = _read_scene(path, scene, order, **selection)
+            else:
+                data = project(
+                    _read(im, order.replace("Z", ""), Z=z, **selection)
+                    for z in range(im.dims.Z)
+                )
+            if "M" not in order:
+                data = data[numpy.newaxis]
+
+        for i in positions:
+            newevent = partition[i].copy()
+            newevent["pixels"] = data[tiles.index(partition[i]["tile"])]
+            newpartition[i] = newevent
+
+    return newpartition
+
+
+def estimate_nbytes(
+    partition, channels, dtype: str = "native", reader_cache_size: int = 8, **kwargs
+) -> int:
+    """Estimates the size in bytes of the pixels of the partition from the tile dimensions of
+    each scene.
+    """
+    scenes = {}
+    for event in partition:
+        key = (str(event["path"]), event["scene"])
+        scenes[key] = scenes.get(key, 0) + 1
+
+    nbytes = 0
+    for (path, scene), ntiles in scenes.items():
+        im, lock = _readers.get(path, capacity=reader_cache_size)
+        with lock:
+            im.set_scene(scene)
+            nchannels = im.dims.C if channels is None else len(channels)
+            tile = nchannels * im.dims.Z * im.dims.Y * im.dims.X * l_util.itemsize(
+                im.dtype.itemsize, dtype)
+        nbytes += ntiles * tile
+    return nbytes
+
+
+def cache_info() -> Mapping[str, int]:
+    """Returns hit and miss counters of the reader cache in this worker process."""
+    return _readers.info()
+
+
 def get_loader_meta(
     *,
     regex: str,
@@ -62,8 +171,7 @@ def get_group_keys():
     return ["scene", "tile"]
 
 
-@dask.delayed
-def meta_from_directory(
+def _scan_file(
     path: str,
     scenes: List[str],
     regex: str = ""
@@ -93,10 +201,44 @@ def meta_from_directory(
     return scenes_meta
 
 
+@dask.delayed
+def meta_from_directory(
+    path: str,
+    scenes: List[str],
+    regex: str = "",
+    manifest: str = None,
+    **kwargs
+) -> List[Mapping[str, Any]]:
+    return l_util.cached_scan(
+        path, partial(_scan_file, path, scenes, regex), manifest,
+        loader="czi", scenes=scenes, regex=regex)
+
+
 def load_pixels(
     images: dask.bag.Bag,
     channels: List[int],
+    reader_cache_size: int = 8,
+    scene_bulk_read: bool = False,
+    prefetch: int = 0,
+    project: Callable[[Iterable[numpy.ndarray]], numpy.ndarray] = None,
     **kwargs
 ) -> dask.bag.Bag:
+    """Loads the pixels of each tile. Readers are kept open in a per-worker cache holding at most
+    reader_cache_size files, so that tiles from the same file share one parsed header.
+
+    If scene_bulk_read is set, the tiles of a scene within a partition are read in one bulk
+    read instead of one read per tile. This trades memory for fewer random seeks, which pays
+    off on network filesystems.
+
+    If project is set to the project_planes function of a projection method, the Z-stack is read
+    one plane at a time and folded into the projection, so that the full stack is never in
+    memory.
+    """
+    if scene_bulk_read:
+        return images.map_partitions(
+            _load_scene_partition, channels=channels, reader_cache_size=reader_cache_size,
+            project=project)
+
+    load = partial(_load_block, reader_cache_size=reader_cache_size, project=project)
     return images.map_partitions(
-        l_util._load_image_partition, channels=channels, load=_load_block)
+        l_util._load_image_partition, channels=channels, load=load, prefetch=prefetch)
@@ -15,64 +15,105 @@
 # You should have received a copy of the GNU General Public License
 # along with SCIP.  If not, see <http://www.gnu.org/licenses/>.
 
+"""
+Data loader for multi-page Tagged Image File format, where each page of a file holds one channel.
+Based on the tifffile package.
+"""
+
+import re
+from typing import List, Mapping
+from functools import partial
+from pathlib import Path
+
 import dask
-from PIL import Image
 import dask.bag
-import dask.dataframe
 import numpy
-from pathlib import Path
-import pandas
+import tifffile
+
+from scip.loading import util as l_util
 
 
 def load_image(event, channels=None):
     """
-    Load an image from a certain path
+    Load an image from a certain path. The requested pages are read with one tifffile call in
+    their native dtype.
 
     Args:
-        path (str): path of image
+        event (dict): event containing the path of the image
         channels (list, optional): image channels to load. Defaults to None.
 
     Returns:
         dict: dictionary containing pixel values (ndarray) and path for each image
     """
-    im = Image.open(event["path"])
-
-    if channels is None:
-        channels = range(im.n_frames)
+    with tifffile.TiffFile(event["path"]) as tif:
+        if channels is None:
+            channels = range(len(tif.pages))
+        arr = tif.asarray(key=list(channels))
 
-    arr = numpy.empty(shape=(len(channels), im.height, im.width), dtype=float)
-    for i, c in enumerate(channels):
-        im.seek(c)
-        arr[i] = numpy.array(im)
+    # tifffile collapses the page axis when only one page is requested
+    if arr.ndim < 3:
+        arr = arr[numpy.newaxis, ...]
 
     newevent = event.copy()
     newevent["pixels"] = arr
     return newevent
 
 
-def bag_from_directory(path, channels, partition_size):
+def estimate_nbytes(partition, channels, dtype: str = "native", **kwargs) -> int:
+    """Estimates the size in bytes of the pixels of the partition from the first file in the
+    partition, assuming all files have the same dimensions.
     """
-    Construct delayed ops for all tiffs in a directory
+    if len(partition) == 0:
+        return 0
 
-    Args:
-        path (str): Directory to find tiffs
+    with tifffile.TiffFile(partition[0]["path"]) as tif:
+        page = tif.pages[0]
+        nchannels = len(tif.pages) if channels is None else len(channels)
+        return len(partition) * nchannels * page.size * l_util.itemsize(
+            page.dtype.itemsize, dtype)
 
-    Returns:
-        dask.bag: bag containing dictionaries with image data
-    """
 
-    def load_image_partition(partition):
-        return [load_image(event, channels) for event in partition]
+def get_loader_meta(
+    *,
+    regex: str = "",
+    **kwargs
+) -> Mapping[str, type]:
+    loader_meta = dict(path=str, group=str)
+    named_groups = re.findall(r"\(\?P\<([^>]+)\>[^)]+\)", regex)
+    for k in named_groups:
+        loader_meta[k] = str
+    return loader_meta
 
-    events = []
-    for i, p in enumerate(Path(path).glob("**/*.tiff")):
-        events.append(dict(path=str(p), group=str(p.parent)))
 
-    meta = pandas.DataFrame.from_records(data=events)
-    meta.columns = [f"meta_{c}" for c in meta.columns]
-    meta = dask.dataframe.from_pandas(meta, chunksize=partition_size)
+def get_group_keys():
+    return []
 
-    bag = dask.bag.from_sequence(events, partition_size=partition_size)
-    bag = bag.map_partitions(load_image_partition)
 
-    return bag, meta
+def _scan_directory(path, regex):
+    events = []
+    for p in sorted(Path(path).glob("**/*.tiff")):
+        m = {}
+        if regex != "":
+            match = re.search(regex, str(p))
+            if match is None:
+                continue
+            m = match.groupdict()
+        events.append(dict(path=str(p), group=str(p.parent), **m))
+    return events
+
+
+@dask.delayed
+def meta_from_directory(path, regex="", manifest=None, **kwargs):
+    return l_util.cached_scan(
+        path, partial(_scan_directory, path, regex), manifest,
+        stamp_paths=partial(l_util.directories, path), loader="multiframe_tiff", regex=regex)
+
+
+def load_pixels(
+    images: dask.bag.Bag,
+    channels: List[int],
+    prefetch: int = 0,
+    **kwargs
+) -> dask.bag.Bag:
+    return images.map_partitions(
+        l_util._load_image_partition, channels=channels, load=load_image, prefetch=prefetch)
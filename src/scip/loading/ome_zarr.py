@@ -0,0 +1,225 @@
+# Copyright (C) 2022 Maxim Lippeveld
+#
+# This file is part of SCIP.
+#
+# SCIP is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SCIP is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with SCIP.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Data loader for OME-Zarr (NGFF) multiscale images. Based on the zarr package. Each input path is
+either one multiscale image group or a directory holding several of them. Pixels are read from
+the full resolution level. If a mask level is configured, the pixels of that coarser pyramid
+level are loaded as well, so that masking and segmentation can run on fewer pixels.
+"""
+
+from typing import List, Mapping, Tuple, Callable, Iterable
+from functools import lru_cache, partial
+from pathlib import Path
+import re
+
+import dask
+import dask.bag
+import numpy
+import zarr
+
+from scip.loading import util as l_util
+
+# Z-stack projection can be fused into loading, see load_pixels
+STREAMING_PROJECTION = True
+
+
+@lru_cache(maxsize=128)
+def _multiscales(path: str) -> Tuple[List[str], List[str]]:
+    """Returns the axis names and the dataset path of each pyramid level, from highest to
+    lowest resolution.
+    """
+    group = zarr.open_group(path, mode="r")
+    multiscale = group.attrs["multiscales"][0]
+
+    # axes are plain names in NGFF 0.3 and dictionaries in later versions
+    axes = [a["name"] if isinstance(a, dict) else a for a in multiscale["axes"]]
+    datasets = [d["path"] for d in multiscale["datasets"]]
+    return axes, datasets
+
+
+def _read_level(
+    path: str,
+    level: int,
+    t: int,
+    channels: List[int],
+    z: slice = None
+) -> numpy.ndarray:
+    """Reads one timepoint of a pyramid level as CZXY, or CXY if the image has no Z axis."""
+    axes, datasets = _multiscales(path)
+    arr = zarr.open_array(str(Path(path) / datasets[level]), mode="r")
+
+    selection = []
+    for a in axes:
+        if a == "t":
+            selection.append(t)
+        elif (a == "z") and (z is not None):
+            selection.append(z)
+        elif (a == "c") and (channels is not None):
+            selection.append(list(channels))
+        else:
+            selection.append(slice(None))
+    data = arr.oindex[tuple(selection)]
+
+    axes = [a for a in axes if a != "t"]
+    if "c" not in axes:
+        data = data[numpy.newaxis]
+        axes = ["c"] + axes
+
+    # pixels are stored as (C)(Z)XY, consistent with the other loaders
+    order = [a for a in ["c", "z", "x", "y"] if a in axes]
+    return numpy.transpose(data, [axes.index(a) for a in order])
+
+
+def _planes(path, level, t, channels):
+    # planes are read in slabs of one chunk deep, so that each chunk is decompressed once
+    axes, datasets = _multiscales(path)
+    arr = zarr.open_array(str(Path(path) / datasets[level]), mode="r")
+    nz, step = arr.shape[axes.index("z")], arr.chunks[axes.index("z")]
+    for start in range(0, nz, step):
+        slab = _read_level(path, level, t, channels, z=slice(start, start + step))
+        yield from numpy.moveaxis(slab, 1, 0)
+
+
+def _nz(path, level):
+    axes, datasets = _multiscales(path)
+    return zarr.open_array(str(Path(path) / datasets[level]), mode="r").shape[axes.index("z")]
+
+
+def _read(path, levels, t, channels, project):
+    """Reads one timepoint of each level. If project is set, the levels are projected in one
+    pass over the Z planes, so that a projection selecting planes selects the same planes at
+    every level. Levels with a different number of Z planes are projected separately.
+    """
+    axes, _ = _multiscales(path)
+    if (project is None) or ("z" not in axes):
+        return [_read_level(path, level, t, channels) for level in levels]
+
+    if len(set(_nz(path, level) for level in levels)) > 1:
+        return [project(_planes(path, level, t, channels)) for level in levels]
+    if len(levels) == 1:
+        return [project(_planes(path, levels[0], t, channels))]
+    return list(project(zip(*[_planes(path, level, t, channels) for level in levels])))
+
+
+def _load_block(event, channels, mask_level, project=None):
+    newevent = event.copy()
+    levels = [0] if mask_level is None else [0, mask_level]
+    pixels = _read(event["path"], levels, event["t"], channels, project)
+    newevent["pixels"] = pixels[0]
+    if mask_level is not None:
+        newevent["pixels_lowres"] = pixels[1]
+    return newevent
+
+
+def estimate_nbytes(partition, channels, dtype: str = "native", **kwargs) -> int:
+    nbytes = 0
+    for event in partition:
+        axes, datasets = _multiscales(event["path"])
+        arr = zarr.open_array(str(Path(event["path"]) / datasets[0]), mode="r")
+        shape = dict(zip(axes, arr.shape))
+        nchannels = shape.get("c", 1) if channels is None else len(channels)
+        npixels = int(numpy.prod([v for k, v in shape.items() if k not in ("t", "c")]))
+        nbytes += nchannels * npixels * l_util.itemsize(arr.dtype.itemsize, dtype)
+    return nbytes
+
+
+def get_loader_meta(
+    *,
+    regex: str = "",
+    **kwargs
+) -> Mapping[str, type]:
+    loader_meta = dict(path=str, name=str, t=int)
+    named_groups = re.findall(r"\(\?P\<([^>]+)\>[^)]+\)", regex)
+    for k in named_groups:
+        loader_meta[k] = str
+    return loader_meta
+
+
+def get_group_keys():
+    return ["name", "t"]
+
+
+def _is_multiscale(path: Path) -> bool:
+    try:
+        return "multiscales" in zarr.open_group(str(path), mode="r").attrs
+    except (zarr.errors.GroupNotFoundError, zarr.errors.ContainsArrayError):
+        return False
+
+
+def _scan_directory(path, regex):
+    path = Path(path)
+    images = [path] if _is_multiscale(path) else [
+        p for p in sorted(path.iterdir()) if p.is_dir() and _is_multiscale(p)]
+
+    events = []
+    for image in images:
+        m = {}
+        if regex != "":
+            match = re.search(regex, str(image))
+            if match is None:
+                continue
+            m = match.groupdict()
+
+        axes, datasets = _multiscales(str(image))
+        arr = zarr.open_array(str(image / datasets[0]), mode="r")
+        ntimepoints = arr.shape[axes.index("t")] if "t" in axes else 1
+
+        events.extend([
+            dict(path=str(image), name=image.stem, t=t, **m)
+            for t in range(ntimepoints)
+        ])
+
+    return events
+
+
+def _stamp_paths(path):
+    # adding images changes the mtime of path, adding timepoints changes the array metadata of
+    # the pyramid levels
+    path = Path(path)
+    images = [path] if _is_multiscale(path) else [p for p in path.iterdir() if p.is_dir()]
+    return [str(path)] + [
+        str(f) for image in images for name in [".zarray", "zarr.json"]
+        for f in image.glob(f"*/{name}")
+    ]
+
+
+@dask.delayed
+def meta_from_directory(path, regex="", manifest=None, **kwargs):
+    return l_util.cached_scan(
+        path, partial(_scan_directory, path, regex), manifest,
+        stamp_paths=partial(_stamp_paths, path), loader="ome_zarr", regex=regex)
+
+
+def load_pixels(
+    images: dask.bag.Bag,
+    channels: List[int],
+    mask_level: int = None,
+    prefetch: int = 0,
+    project: Callable[[Iterable[numpy.ndarray]], numpy.ndarray] = None,
+    **kwargs
+) -> dask.bag.Bag:
+    """Loads the full resolution pixels of each image. If mask_level is set, the pixels of that
+    pyramid level are added as pixels_lowres, for use in masking and segmentation.
+
+    If project is set to the project_planes function of a projection method, the Z-stack is read
+    one plane at a time and folded into the projection, so that the full stack is never in
+    memory.
+    """
+    load = partial(_load_block, mask_level=mask_level, project=project)
+    return images.map_partitions(
+        l_util._load_image_partition, channels=channels, load=load, prefetch=prefetch)
@@ -24,10 +24,12 @@ channel and id named group.
 
 from typing import Callable, List, Mapping, Any
 
+import os
 import re
 import logging
 from pathlib import Path
 from functools import partial
+from fnmatch import fnmatch
 
 import pandas
 import dask
@@ -42,39 +44,50 @@ from scip.loading import util as l_util
 logging.getLogger("tifffile").setLevel(logging.ERROR)
 
 
+def _read_page(path: str, maxworkers: int) -> numpy.ndarray:
+    """Reads the first page of a TIFF file. Uncompressed pages are memory-mapped, compressed
+    pages are decoded using up to maxworkers threads.
+    """
+    with tifffile.TiffFile(path) as tif:
+        page = tif.pages[0]
+        if page.is_memmappable:
+            return tif.asarray(key=0, out="memmap")
+        return page.asarray(maxworkers=maxworkers)
+
+
 def _load_image_tiff(
     event: Mapping[str, Any],
-    channels: List[int]
+    channels: List[int],
+    maxworkers: int = 1
 ):
     """Adds pixels attribute containing pixel values of this event. Values are loaded from
-    one file per channel.
+    one file per channel directly with tifffile, into one preallocated array in the stored
+    dtype.
 
     Keyword args:
         event (Mapping[str, Any]): Contains information for an event. Must contain keys
             corresponding to each channel.
         channels (List[int]): List of channels to load.
+        maxworkers (int): Maximum number of threads used to decode a compressed page.
 
     Returns:
         event (Mapping[str, Any]): event with pixel values.
     """
 
-    try:
-        paths = [event[str(c)] for c in channels]
-        arr = tifffile.imread(paths)
-        arr = arr.astype(numpy.float32)
+    paths = [event[str(c)] for c in channels]
+
+    arr = None
+    for i, path in enumerate(paths):
+        page = _read_page(path, maxworkers)
+        if arr is None:
+            arr = numpy.empty(shape=(len(paths),) + page.shape[::-1], dtype=page.dtype)
 
-        # tifffile collapses axis with size 1,
-        # occurrs when only one path is passed
-        if len(arr.shape) < 3:
-            arr = arr[numpy.newaxis, ...]
+        # pixels are stored as CXY, consistent with the aicsimageio based loaders
+        arr[i] = page.T
 
-        newevent = event.copy()
-        newevent["pixels"] = arr
-        return newevent
-    except TypeError as e:
-        logging.getLogger(__name__).exception(e)
-        logging.getLogger(__name__).error(paths)
-        raise e
+    newevent = event.copy()
+    newevent["pixels"] = arr
+    return newevent
 
 
 def _load_block(
@@ -104,10 +117,23 @@ def _load_block(
     ).get_image_data("CXY")
 
     newevent = event.copy()
-    newevent["pixels"] = im.astype(numpy.float32)
+    newevent["pixels"] = im
     return newevent
 
 
+def estimate_nbytes(partition, channels, dtype: str = "native", **kwargs) -> int:
+    """Estimates the size in bytes of the pixels of the partition from the first page of the
+    first file in the partition, assuming all files have the same dimensions.
+    """
+    if len(partition) == 0:
+        return 0
+
+    with tifffile.TiffFile(partition[0][str(channels[0])]) as tif:
+        page = tif.pages[0]
+        return len(partition) * len(channels) * page.size * l_util.itemsize(
+            page.dtype.itemsize, dtype)
+
+
 def get_loader_meta(**kwargs) -> Mapping[str, type]:
     """Returns key to type mapping of metadata."""
     return dict(path=str)
@@ -117,14 +143,32 @@ def get_group_keys():
     return []
 
 
+def get_shards(path: str, subdirectories: bool = False, **kwargs) -> List[str]:
+    """Returns the directories that are scanned for metadata. If subdirectories is set, path is
+    a root directory and each of its subdirectories is scanned as a separate shard. TIFF files
+    directly in the root are scanned in a shard of their own.
+    """
+    if not subdirectories:
+        return [path]
+
+    with os.scandir(path) as it:
+        entries = list(it)
+
+    shards = sorted(entry.path for entry in entries if entry.is_dir())
+    if any(entry.is_file() and fnmatch(entry.name, "*.tif*") for entry in entries):
+        shards.insert(0, path)
+
+    assert len(shards) > 0, f"No subdirectories or TIFF files found in {path}"
+    return shards
+
+
 def _map_to_index(f, regex, channels):
     idx = int(re.search(regex, str(f)).group("channel"))
     m = {c: i for i, c in enumerate(channels)}
     return pandas.Series(dict(S=0, T=0, C=m[idx], Z=0))
 
 
-@dask.delayed
-def meta_from_directory(path, regex):
+def _scan_directory(path, regex):
     logger = logging.getLogger(__name__)
 
     path = Path(path)
@@ -141,6 +185,10 @@ def meta_from_directory(path, regex):
             })
             i += 1
 
+    if len(matches) == 0:
+        logger.warning("No files matched in %s" % str(path))
+        return []
+
     df = pandas.DataFrame.from_dict(matches)
     df1 = df.pivot(index="id", columns="channel", values="path")
     df = df.set_index("id")
@@ -158,17 +206,32 @@ def meta_from_directory(path, regex):
     return df.to_dict(orient="records")
 
 
+@dask.delayed
+def meta_from_directory(path, regex, manifest=None, **kwargs):
+    return l_util.cached_scan(
+        path, partial(_scan_directory, path, regex), manifest, loader="tiff", regex=regex)
+
+
 def load_pixels(
     images: dask.bag.Bag,
     channels: List[int],
     regex: str,
+    reader: str = "tifffile",
+    maxworkers: int = 1,
+    prefetch: int = 0,
     **kwargs
 ) -> dask.bag.Bag:
-    _m2i = partial(_map_to_index, channels=channels, regex=regex)
-    func = partial(_load_block, map_to_index=_m2i)
+    """Loads the pixels of each event. The tifffile reader reads pages straight into one
+    stacked array, the aicsimageio reader goes through a TiffGlobReader per event.
+    """
 
-    return images.map_partitions(l_util._load_image_partition, channels=channels, load=func)
+    if reader == "tifffile":
+        func = partial(_load_image_tiff, maxworkers=maxworkers)
+    elif reader == "aicsimageio":
+        _m2i = partial(_map_to_index, channels=channels, regex=regex)
+        func = partial(_load_block, map_to_index=_m2i)
+    else:
+        raise ValueError(f"Unknown TIFF reader {reader}.")
 
-    # bag = dask.bag.from_delayed(meta)
-    # bag = bag.map_partitions(
-    #     l_util._load_image_partition, channels=channels, load=_load_image_tiff)
+    return images.map_partitions(
+        l_util._load_image_partition, channels=channels, load=func, prefetch=prefetch)
@@ -1,46 +1,197 @@
+import os
+import time
 import logging
-from typing import List, Tuple, Mapping, Any
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Callable, List, Tuple, Mapping, Any, Optional
 
-import dask.bag
+import dask.base
+import pandas
+import pyarrow
+import pyarrow.parquet
 
 from pathlib import Path
-from functools import partial
 
 
-def _load_image_partition(partition, channels, load):
+class PrefetchStats:
+    """Counters describing how far ahead the prefetcher ran in this worker process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = 0
+        self.ready = 0
+        self.wait = 0.0
+
+    def add(self, events: int, ready: int, wait: float):
+        with self.lock:
+            self.events += events
+            self.ready += ready
+            self.wait += wait
+
+    def info(self) -> Mapping[str, float]:
+        with self.lock:
+            return dict(
+                events=self.events,
+                mean_queue_depth=self.ready / max(self.events, 1),
+                wait=self.wait
+            )
+
+
+_prefetch_stats = PrefetchStats()
+
+
+def prefetch_info() -> Mapping[str, float]:
+    """Returns prefetch counters of this worker process."""
+    return _prefetch_stats.info()
+
+
+def _prefetch_partition(partition, channels, load, prefetch):
+    """Loads events with a bounded thread pool that keeps prefetch events in flight ahead of
+    the event that is being collected.
+
+    Records the number of events that were already loaded when an event was collected (the
+    queue depth) and the time spent waiting for events that were not.
+    """
+
+    events = iter(partition)
+    out = []
+    ready = 0
+    wait = 0.0
+
+    with ThreadPoolExecutor(max_workers=prefetch) as executor:
+        pending = deque(executor.submit(load, e, channels) for e in islice(events, prefetch))
+        while len(pending) > 0:
+            future = pending.popleft()
+            ready += sum(f.done() for f in pending) + future.done()
+
+            start = time.perf_counter()
+            out.append(future.result())
+            wait += time.perf_counter() - start
+
+            for event in islice(events, 1):
+                pending.append(executor.submit(load, event, channels))
+
+    _prefetch_stats.add(len(out), ready, wait)
+    logging.getLogger(__name__).debug(
+        "Prefetched %d events, mean queue depth %.2f, waited %.3fs",
+        len(out), ready / max(len(out), 1), wait)
+
+    return out
+
+
+def _load_image_partition(partition, channels, load, prefetch=0):
+    if prefetch > 0:
+        return _prefetch_partition(partition, channels, load, prefetch)
     return [load(event, channels) for event in partition]
 
 
-def get_images_bag(
-    *,
-    paths: List[str],
-    output: Path,
-    channels: List[int],
-    config: Mapping[str, Any],
-    partition_size: int,
-    gpu_accelerated: bool,
-    loader_module
-) -> Tuple[dask.bag.Bag, Mapping[str, type]]:
+def itemsize(native: int, dtype: str = "native") -> int:
+    """Returns the size in bytes of one pixel while loading under a pixel dtype policy. Under the
+    float32 policy, pixels are cast after being read, so the larger of both sizes is counted.
+    """
+    if dtype == "float32":
+        return max(native, 4)
+    return native
+
+
+def directories(path: str) -> List[str]:
+    """Returns path and all directories below it, for scans that descend into subdirectories."""
+    return [root for root, _, _ in os.walk(path)]
+
+
+def cached_scan(
+    path: str,
+    scan: Callable[[], List[Mapping[str, Any]]],
+    manifest: Optional[str],
+    stamp_paths: Optional[Callable[[], List[str]]] = None,
+    **params
+) -> List[Mapping[str, Any]]:
+    """Returns the events found by scan, using an on-disk manifest to skip the scan on reruns.
+
+    The manifest is a parquet file in the manifest directory, named after the absolute path and
+    the scan parameters. It is reused as long as the modification times of the stamp paths are
+    unchanged, otherwise path is rescanned and the manifest is replaced.
+
+    Args:
+        path: File or directory that is scanned.
+        scan: Callable producing the events for path.
+        manifest: Directory to keep manifests in. If None, scan is always called.
+        stamp_paths: Callable listing the paths of which the modification times key the
+            manifest. Scans that look beyond the entries of path, such as recursive scans, must
+            list every path in which changes affect the events. Defaults to path only.
+        params: Parameters that influence the outcome of scan, such as a regex.
+
+    Returns:
+        Events for path.
+    """
+
+    if manifest is None:
+        return scan()
+
+    paths = [str(path)] if stamp_paths is None else stamp_paths()
+    mtime = dask.base.tokenize([(str(p), os.stat(p).st_mtime_ns) for p in paths]).encode()
+    token = dask.base.tokenize(os.path.abspath(str(path)), params)
+    manifest_file = Path(manifest) / f"{token}.parquet"
+
+    if manifest_file.exists():
+        table = pyarrow.parquet.read_table(manifest_file)
+        if (table.schema.metadata or {}).get(b"scip_mtime") == mtime:
+            logging.getLogger(__name__).debug("Loaded manifest for %s", str(path))
+            return table.to_pandas().to_dict(orient="records")
+
+    events = scan()
+
+    table = pyarrow.Table.from_pandas(pandas.DataFrame.from_records(events), preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), b"scip_mtime": mtime})
+
+    # write to a temporary file first so that concurrent runs never read a partial manifest
+    Path(manifest).mkdir(parents=True, exist_ok=True)
+    tmp_file = manifest_file.with_suffix(f".{os.getpid()}.tmp")
+    pyarrow.parquet.write_table(table, tmp_file)
+    os.replace(tmp_file, manifest_file)
+
+    return events
+
+
+class ReaderCache:
+    """Least-recently-used cache of open image readers keyed by path. One instance lives in
+    each worker process, so that events from the same file reuse one parsed reader.
 
-    loader = partial(
-        loader_module.bag_from_directory,
-        channels=channels,
-        partition_size=partition_size,
-        gpu_accelerated=gpu_accelerated,
-        output=output,
-        **(config["load"]["kwargs"] or dict())
-    )
+    Readers are returned together with a lock, which must be held while the reader is used as
+    readers carry state such as the active scene.
+    """
 
-    images = []
+    def __init__(self, factory: Callable[[str], Any]):
+        self.factory = factory
+        self.readers = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
-    loader_meta = loader_module.get_loader_meta(**(config["load"]["kwargs"] or dict()))
+    def get(self, path: str, capacity: int) -> Tuple[Any, threading.Lock]:
+        with self.lock:
+            if path in self.readers:
+                self.readers.move_to_end(path)
+                self.hits += 1
+            else:
+                self.readers[path] = (self.factory(path), threading.Lock())
+                self.misses += 1
 
-    for path in paths:
-        assert Path(path).exists(), f"{path} does not exist."
+            entry = self.readers[path]
+            while len(self.readers) > capacity:
+                self.readers.popitem(last=False)
+                self.evictions += 1
 
-        logging.info(f"Bagging {path}")
-        bag = loader(path=path)
-        images.append(bag)
+            return entry
 
-    images = dask.bag.concat(images)
-    return images, loader_meta
+    def info(self) -> Mapping[str, int]:
+        with self.lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                size=len(self.readers)
+            )
@@ -26,10 +26,68 @@ from typing import Mapping, List
 import dask
 import dask.bag
 import dask.dataframe
+from dask.delayed import Delayed
 import zarr
 import numpy
 import re
-import copy
+from functools import lru_cache, partial
+
+from scip.loading import util as l_util
+
+
+def _group_by_path(partition: List) -> Mapping[str, List[int]]:
+    """Maps each zarr path in the partition to the positions of its events."""
+    groups = {}
+    for i, event in enumerate(partition):
+        groups.setdefault(event["path"], []).append(i)
+    return groups
+
+
+@lru_cache(maxsize=16)
+def _shape_index(path: str) -> numpy.ndarray:
+    """Parses the shape attribute of the zarr store once per worker and caches it as an integer
+    array with one row per object.
+    """
+    z = zarr.open(path, mode="r")
+    return numpy.asarray(z.attrs["shape"], dtype=numpy.int64)
+
+
+def _itemsize(z: zarr.Array) -> int:
+    """Returns the size in bytes of one pixel, also for arrays of flattened objects."""
+    for f in (z.filters or []):
+        if hasattr(f, "dtype"):
+            return numpy.dtype(f.dtype).itemsize
+    return z.dtype.itemsize
+
+
+def _read_objects(z: zarr.Array, indices: List[int]) -> List[numpy.ndarray]:
+    """Reads the objects at the given indices using one bulk selection per run of neighbouring
+    chunks, so that every chunk is decoded once regardless of how many objects it holds.
+
+    Args:
+        z: Zarr array holding flattened objects.
+        indices: Indices of the objects to read, in any order.
+
+    Returns:
+        Flattened objects in the same order as indices.
+    """
+
+    indices = numpy.asarray(indices)
+    order = numpy.argsort(indices, kind="stable")
+    sorted_indices = indices[order]
+
+    # split the sorted indices where the gap between chunks is larger than one
+    chunk_ids = sorted_indices // z.chunks[0]
+    breaks = numpy.flatnonzero(numpy.diff(chunk_ids) > 1) + 1
+
+    objects = [None] * len(indices)
+    for run in numpy.split(numpy.arange(len(indices)), breaks):
+        start, stop = sorted_indices[run[0]], sorted_indices[run[-1]] + 1
+        block = z[start:stop]
+        for j in run:
+            objects[order[j]] = block[sorted_indices[j] - start]
+
+    return objects
 
 
 def reload_image_partition(
@@ -37,37 +95,49 @@ def reload_image_partition(
     channels: List[int],
     regex: str
 ):
-    z = zarr.open(partition[0]["path"])
-    indices = [p["zarr_idx"] for p in partition]
-    data = z.get_coordinate_selection(indices)
-    shapes = numpy.array(z.attrs["shape"])[indices]
-
-    newpartition = copy.deepcopy(partition)
-    for i in range(len(partition)):
-        if "mask" in partition[i]:
-            newpartition[i]["pixels"] = data[i].reshape(shapes[i])[channels].astype(numpy.float32)
+    newpartition = list(partition)
+    for path, positions in _group_by_path(partition).items():
+        z = zarr.open(path, mode="r")
+        shapes = _shape_index(str(path))
+
+        positions = [i for i in positions if "mask" in partition[i]]
+        if len(positions) == 0:
+            continue
+
+        indices = [partition[i]["zarr_idx"] for i in positions]
+        for i, idx, data in zip(positions, indices, _read_objects(z, indices)):
+            newpartition[i] = partition[i].copy()
+            newpartition[i]["pixels"] = data.reshape(shapes[idx])[channels]
+
     return newpartition
 
 
 def load_image_partition(partition, channels):
 
-    newpartition = copy.deepcopy(partition)
-    for i, part in enumerate(partition):
-        z = zarr.open(part["path"])
-        tmp = z[part["zarr_idx"]]
-        tmp = tmp.reshape(z.attrs["shape"][part["zarr_idx"]])[channels]
-        newpartition[i]["pixels"] = tmp
+    newpartition = [None] * len(partition)
+    for path, positions in _group_by_path(partition).items():
+        z = zarr.open(path, mode="r")
+        shapes = _shape_index(str(path))
+
+        indices = [partition[i]["zarr_idx"] for i in positions]
+        for i, idx, data in zip(positions, indices, _read_objects(z, indices)):
+            newpartition[i] = partition[i].copy()
+            newpartition[i]["pixels"] = data.reshape(shapes[idx])[channels]
 
     return newpartition
 
-    # start, end = partition[0]["zarr_idx"], partition[-1]["zarr_idx"]
-    # data = z[start:end + 1]
-    # shapes = z.attrs["shape"][start:end + 1]
 
-    # for i in range(len(partition)):
-    #     partition[i]["pixels"] = data[i].reshape(shapes[i])[channels].astype(numpy.float32)
+def estimate_nbytes(partition, channels, dtype: str = "native", **kwargs) -> int:
+    """Estimates the size in bytes of the pixels of the partition from the shape index."""
+    nbytes = 0
+    for path, positions in _group_by_path(partition).items():
+        z = zarr.open(path, mode="r")
+        shapes = _shape_index(str(path))[[partition[i]["zarr_idx"] for i in positions]]
 
-    # return partition
+        nchannels = shapes[:, 0] if channels is None else len(channels)
+        nbytes += int((nchannels * shapes[:, 1:].prod(axis=1)).sum()) * l_util.itemsize(
+            _itemsize(z), dtype)
+    return nbytes
 
 
 def get_loader_meta(
@@ -86,8 +156,7 @@ def get_group_keys():
     return []
 
 
-@dask.delayed
-def meta_from_directory(path, regex):
+def _scan_store(path, regex):
     match = re.search(regex, str(path))
     groups = match.groupdict()
 
@@ -96,7 +165,7 @@ def meta_from_directory(path, regex):
     events = []
     for i, obj in enumerate(z.attrs["object_number"]):
         events.append({**groups, **{
-            "path": path,
+            "path": str(path),
             "zarr_idx": i,
             "object_number": obj
         }})
@@ -104,6 +173,37 @@ def meta_from_directory(path, regex):
     return events
 
 
+@dask.delayed
+def _meta_from_store(path, regex, manifest):
+    return l_util.cached_scan(
+        path, partial(_scan_store, path, regex), manifest, loader="zarr", regex=regex)
+
+
+def meta_from_directory(path, regex, manifest=None, **kwargs) -> List[Delayed]:
+    """Returns the events in the zarr store split in one delayed list per chunk, so that
+    partitions built from these lists line up with the chunk grid of the store.
+    """
+
+    z = zarr.open(path, mode="r")
+    chunk_size = z.chunks[0]
+
+    events = _meta_from_store(path, regex, manifest)
+    return [
+        events[i * chunk_size:(i + 1) * chunk_size]
+        for i in range(max(z.nchunks, 1))
+    ]
+
+
+def repartition(
+    bag: dask.bag.Bag,
+    npartitions: int
+) -> dask.bag.Bag:
+    """Merges neighbouring chunk partitions. Partitions are never split, as that would make
+    neighbouring partitions decode the same chunk.
+    """
+    return bag.repartition(npartitions=min(npartitions, bag.npartitions))
+
+
 def load_pixels(
     images: dask.bag.Bag,
     channels: List[int],
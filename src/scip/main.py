@@ -15,7 +15,7 @@
 # You should have received a copy of the GNU General Public License
 # along with SCIP.  If not, see <http://www.gnu.org/licenses/>.
 
-from typing import Any, Optional, List
+from typing import Any, Optional, List, Union
 
 import time
 import os
@@ -23,6 +23,7 @@ import logging
 import logging.config
 from pathlib import Path
 from importlib import import_module
+from functools import partial
 
 import click
 import dask.bag
@@ -30,7 +31,8 @@ import dask.dataframe
 import dask.dataframe.multi
 import pandas
 
-from scip.loading import load_meta, load_pixels
+from scip.loading import load_meta, load_pixels, repartition, auto_npartitions, sample_meta
+from scip.loading import util as loader_util
 from scip.utils.util import copy_without, prerun
 from scip.utils import util  # noqa: E402
 from scip.features import compute_features  # noqa: E402
@@ -47,7 +49,7 @@ warnings.simplefilter("ignore", category=FutureWarning)
 
 
 @dask.delayed
-def channel_boundaries(quantiles, *, config, output):
+def channel_boundaries(quantiles, *, config, output, suffix=""):
     data = []
     index = []
     for k, v in quantiles:
@@ -57,7 +59,8 @@ def channel_boundaries(quantiles, *, config, output):
             out[f"{channel}_min"] = r[0]
             out[f"{channel}_max"] = r[1]
         data.append(out)
-    pandas.DataFrame(data=data, index=index).to_csv(str(output / "channel_boundaries.csv"))
+    pandas.DataFrame(data=data, index=index).to_csv(
+        str(output / f"channel_boundaries{suffix}.csv"))
 
 
 def main(  # noqa: C901
@@ -68,7 +71,8 @@ def main(  # noqa: C901
     mode: str,
     limit: Optional[int] = -1,
     with_replacement: Optional[bool] = False,
-    n_partitions: Optional[int] = 10,
+    sample_cells: Optional[bool] = False,
+    n_partitions: Optional[Union[int, str]] = 10,
     n_workers: Optional[int] = 1,
     n_nodes: Optional[int] = 1,
     n_cores: Optional[int] = None,
@@ -136,6 +140,8 @@ def main(  # noqa: C901
         channels = config["load"]["channels"]
         channel_names = config["load"]["channel_names"]
         assert len(channels) == len(channel_names), "Please specify a name for each channel"
+        dtype = config["load"].get("dtype", "native")
+        assert dtype in util.DTYPES, f"Pixel dtype policy must be one of {util.DTYPES}"
 
         loader_module = import_module('scip.loading.%s' % config["load"]["format"])
         # with dask.config.set(**{'array.slicing.split_large_chunks': False}):
@@ -144,22 +150,74 @@ def main(  # noqa: C901
             paths=paths,
             kwargs=config["load"]["kwargs"] or dict(),
             loader_module=loader_module
-        ).persist()
-        images = meta.repartition(npartitions=n_partitions)
+        )
+
+        # sampling images is done before loading, so that images that are not sampled are never
+        # read. Sampling cells can only be done after segmentation.
+        if (limit > 0) and (not sample_cells):
+            meta = sample_meta(
+                bag=meta.persist(),
+                k=limit,
+                with_replacement=with_replacement
+            )
+
+        # the groups of the illumination correction are discovered in the same pass that
+        # persists the metadata, instead of in a separate compute later on
+        groups = None
+        if config["illumination_correction"] is not None:
+            key = config["illumination_correction"]["key"]
+            meta, groups = dask.persist(meta, meta.pluck(key).distinct())
+        else:
+            meta = meta.persist()
+
+        if n_partitions == "auto":
+            budget, nthreads = util.partition_budget(context.client)
+            n_partitions = auto_npartitions(
+                bag=meta,
+                channels=channels,
+                budget=budget,
+                min_npartitions=nthreads,
+                dtype=dtype,
+                kwargs=config["load"]["kwargs"] or dict(),
+                loader_module=loader_module
+            )
+            logger.info(f"Automatic partitioning into {n_partitions} partitions")
+
+        images = repartition(
+            bag=meta,
+            npartitions=n_partitions,
+            loader_module=loader_module
+        )
+
+        # projection is fused into loading if both the loader and the projection method support
+        # it, so that the full Z-stack of an image is never in memory
+        project_module = None
+        project_planes = None
+        if config["project"] is not None:
+            project_module = import_module('scip.projection.%s' % config["project"]["method"])
+            if all([
+                hasattr(project_module, "project_planes"),
+                getattr(loader_module, "STREAMING_PROJECTION", False)
+            ]):
+                project_planes = partial(
+                    project_module.project_planes, **(config["project"]["settings"] or dict()))
 
         images = load_pixels(
             bag=images,
             channels=channels,
+            dtype=dtype,
+            project=project_planes,
             kwargs=config["load"]["kwargs"] or dict(),
             loader_module=loader_module
         )
 
-        if config["project"] is not None:
-            project_method = config["project"]["method"]
-            project_kw = config["project"]["settings"]
-            project_block = import_module('scip.projection.%s' % project_method).project_block
+        if (project_module is not None) and (project_planes is None):
             images = images.map_partitions(
-                project_block_partition, proj=project_block, **project_kw)
+                project_block_partition,
+                proj=project_module.project_block,
+                **(config["project"]["settings"] or dict())
+            )
+            images = images.map_partitions(util.enforce_dtype_partition, dtype=dtype)
 
         if config["illumination_correction"] is not None:
             method = config["illumination_correction"]["method"]
@@ -172,10 +230,11 @@ def main(  # noqa: C901
             images = correct(
                 images=images,
                 key=key,
-                ngroups=len(meta.distinct(key).compute()),
+                groups=groups,
                 output=ill_corr_output,
                 **config["illumination_correction"]["settings"],
             )
+            images = images.map_partitions(util.enforce_dtype_partition, dtype=dtype)
 
         if config["segment"] is not None:
             images = segment(
@@ -185,10 +244,12 @@ def main(  # noqa: C901
                 export=config["segment"]["export"],
                 output=output,
                 gpu=gpu,
-                loader_module=loader_module
+                loader_module=loader_module,
+                lowres=config["segment"].get("lowres", False)
             )
+            images = images.map_partitions(util.enforce_dtype_partition, dtype=dtype)
 
-        if limit > 0:
+        if (limit > 0) and sample_cells:
             from dask.bag.random import sample, choices
             if with_replacement:
                 images = choices(images, k=limit)
@@ -226,18 +287,42 @@ def main(  # noqa: C901
                     channels=channels,
                     **(config["load"]["kwargs"] or dict())
                 )
+                images = images.map_partitions(util.enforce_dtype_partition, dtype=dtype)
 
             quantiles = None
             if config["normalization"] is not None:
                 logger.debug("performing normalization")
                 from scip.normalization import quantile_normalization  # noqa: E402
-                images, quantiles = quantile_normalization.quantile_normalization(
-                    images,
-                    config["normalization"]["lower"],
-                    config["normalization"]["upper"],
-                    len(channels)
-                )
-                futures.append(channel_boundaries(quantiles, config=config, output=output))
+                suffix = "" if prefix == "no" else f"_{prefix}"
+                mode = config["normalization"].get("mode", "fit")
+                assert mode in quantile_normalization.MODES, \
+                    f"Normalization mode must be one of {quantile_normalization.MODES}"
+                # the output directory is cleared at startup, so it cannot hold the bounds to
+                # transform with
+                assert (mode == "fit") or config["normalization"].get("path"), \
+                    "Normalization in transform mode requires the path of the bounds"
+                statistics_path = Path(config["normalization"].get("path") or output)
+                statistics_path = statistics_path / f"normalization{suffix}.npz"
+                # feature sets share pixels, so these can only be overwritten if there is one
+                inplace = config["normalization"].get("inplace", False)
+                assert (not inplace) or (len(images_dict) == 1), \
+                    "In place normalization requires a single feature set"
+                if mode == "transform":
+                    images, quantiles = quantile_normalization.transform(
+                        images, statistics_path, inplace=inplace)
+                else:
+                    images, quantiles = quantile_normalization.quantile_normalization(
+                        images,
+                        config["normalization"]["lower"],
+                        config["normalization"]["upper"],
+                        len(channels),
+                        alpha=config["normalization"].get("alpha", 0.005),
+                        sketches_path=output / f"normalization_sketches{suffix}.npz",
+                        statistics_path=statistics_path,
+                        inplace=inplace
+                    )
+                futures.append(channel_boundaries(
+                    quantiles, config=config, output=output, suffix=suffix))
 
             logger.debug("computing features")
 
@@ -274,6 +359,13 @@ def main(  # noqa: C901
 
         dask.compute(*futures, traverse=False, optimize_graph=False)
 
+        if hasattr(loader_module, "cache_info"):
+            for worker, info in context.client.run(loader_module.cache_info).items():
+                logger.info(f"Reader cache on {worker}: {info}")
+        if (config["load"]["kwargs"] or dict()).get("prefetch", 0) > 0:
+            for worker, info in context.client.run(loader_util.prefetch_info).items():
+                logger.info(f"Prefetch on {worker}: {info}")
+
         if debug:
             context.client.profile(filename=str(output / "profile.html"))
 
@@ -289,6 +381,18 @@ def _print_version(ctx, param, value):
     ctx.exit()
 
 
+def _parse_n_partitions(ctx, param, value):
+    if value == "auto":
+        return value
+    try:
+        n_partitions = int(value)
+    except ValueError:
+        raise click.BadParameter("must be a positive integer or auto")
+    if n_partitions < 1:
+        raise click.BadParameter("must be a positive integer or auto")
+    return n_partitions
+
+
 @click.command(
     name="Scalable imaging pipeline",
     context_settings=dict(show_default=True)
@@ -319,6 +423,9 @@ def _print_version(ctx, param, value):
 @click.option(
     "--with-replacement", type=bool, is_flag=True, default=False,
     help="Enable sampling with replacement. Has no effect is limit is set to default.")
+@click.option(
+    "--sample-cells", type=bool, is_flag=True, default=False,
+    help="Sample segmented cells instead of images. Requires all images to be loaded.")
 @click.option(
     "--walltime", "-w", type=str, default="01:00:00",
     help="Expected required walltime for the job to finish")
@@ -329,8 +436,8 @@ def _print_version(ctx, param, value):
     "--headless", default=False, is_flag=True,
     help="If set, the program will never ask for user input")
 @click.option(
-    "--n-partitions", "-s", default=10, type=click.IntRange(min=1),
-    help="Set number of partitions")
+    "--n-partitions", "-s", default="10", callback=_parse_n_partitions,
+    help="Set number of partitions, or auto to size partitions to the memory of the workers")
 @click.option(
     "--scheduler-adress", default=None, type=str,
     help="Adress of scheduler to connect to."
@@ -16,7 +16,6 @@
 # along with SCIP.  If not, see <http://www.gnu.org/licenses/>.
 
 from typing import Mapping, Any, List
-import copy
 
 import numpy
 
@@ -26,7 +25,7 @@ from skimage.measure import regionprops
 from skimage.morphology import remove_small_objects, label, remove_small_holes
 from skimage.segmentation import expand_labels
 
-from scip.utils.util import copy_without, check
+from scip.utils.util import copy_without, check, to_lowres_partition, to_fullres_partition
 from importlib import import_module
 
 
@@ -49,10 +48,16 @@ def mask(
     for method in methods:
         masking_module = import_module('scip.masking.%s' % method["method"])
 
+        # masks can be computed on the low resolution pixels of a multiscale image
+        lowres = method.get("lowres", False)
+
+        tmp_images = images.map_partitions(to_lowres_partition) if lowres else images
         tmp_images = masking_module.create_masks_on_bag(
-            images,
+            tmp_images,
             **(method["kwargs"] or dict())
         )
+        if lowres:
+            tmp_images = tmp_images.map_partitions(to_fullres_partition)
 
         tmp_images = tmp_images.map_partitions(
             remove_regions_touching_border_partition,
@@ -78,9 +83,11 @@ def compute_filters(
     main_channel_index: int
 ) -> List[Mapping[str, Any]]:
 
-    newpartition = copy.deepcopy(partition)
-    for p in newpartition:
-        p["mask_filter"] = [True] * len(p["pixels"])
+    newpartition = []
+    for p in partition:
+        newevent = p.copy()
+        newevent["mask_filter"] = [True] * len(p["pixels"])
+        newpartition.append(newevent)
 
     for filter_ in (config or []):
         mod = import_module("scip.masking.filters.%s" % filter_["method"])
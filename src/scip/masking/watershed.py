@@ -31,21 +31,24 @@ def get_mask(el, noisy_channels):
 
     for dim in range(len(image)):
 
+        # computed on a float32 copy: denoising rescales integer channels to [0, 1], and the
+        # pixels are shared with other masking methods
+        channel = image[dim].astype(numpy.float32)
         if dim in noisy_channels:
-            image[dim] = denoise_nl_means(image[dim], patch_size=2, patch_distance=1)
+            channel = denoise_nl_means(channel, patch_size=2, patch_distance=1)
 
-        elev_map = sobel(image[dim])
+        elev_map = sobel(channel)
         closed = morphology.closing(elev_map, footprint=morphology.disk(2))
 
-        # markers = numpy.zeros_like(image[dim])
+        # markers = numpy.zeros_like(channel)
         # markers[closed < numpy.quantile(closed, 0.7)] = 1
         # markers[closed > numpy.quantile(closed, 0.95)] = 2
-        markers = numpy.zeros_like(image[dim])
+        markers = numpy.zeros(shape=channel.shape, dtype=numpy.int32)
         thresh = threshold_otsu(closed)
         markers[closed < thresh - thresh * 0.5] = 1
         markers[closed > thresh + thresh * 0.5] = 2
 
-        segmentation = watershed(image[dim], markers, compactness=1)
+        segmentation = watershed(channel, markers, compactness=1)
 
         if segmentation.max() == 0:
             mask[dim] = False
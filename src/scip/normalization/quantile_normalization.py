@@ -15,73 +15,248 @@
 # You should have received a copy of the GNU General Public License
 # along with SCIP.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
 import numpy as np
 import dask
 import dask.bag
 import dask.array
+from pathlib import Path
 from scip.utils.util import check, copy_without
+from functools import partial
+from numba import njit
+from scip.normalization.sketch import QuantileSketch, save_sketches
 
+MODES = ["fit", "transform"]
 
-def get_distributed_minmax(bag, nchannels):  # noqa: C901
 
-    def combine_extent_partition(a, b):
+def _channel_values(event, i):
+    if "mask" in event:
+        return event["pixels"][i][event["mask"][i]]
+    return event["pixels"][i]
 
-        if "pixels" not in b:
-            return a
 
-        if "mask" in b:
-            b = [b["pixels"][i][b["mask"][i]] for i in range(nchannels)]
+@njit(cache=True)
+def _masked_extremes(pixels, mask):
+    out = np.empty((pixels.shape[0], 2))
+    for c in range(pixels.shape[0]):
+        lo, hi = np.inf, -np.inf
+        for j in range(pixels.shape[1]):
+            # branchless, as masks are too irregular for branch prediction
+            v = float(pixels[c, j])
+            lo = min(lo, v if mask[c, j] else np.inf)
+            hi = max(hi, v if mask[c, j] else -np.inf)
+        out[c, 0] = lo
+        out[c, 1] = hi
+    return out
+
+
+def _extremes(pixels, mask=None):
+    """Per channel minimum and maximum of the (masked) pixels, computed in one pass without
+    copying the masked pixels. Channels without masked pixels get an infinite extent that does
+    not affect other extents.
+    """
+    pixels = pixels.reshape(len(pixels), -1)
+    if mask is None:
+        return np.stack([pixels.min(axis=1), pixels.max(axis=1)], axis=1).astype(float)
+    return _masked_extremes(pixels, mask.reshape(len(mask), -1))
+
+
+def _partition_minmax(part):
+    extents = {}
+    for event in part:
+        if "pixels" not in event:
+            continue
+        extent = _extremes(event["pixels"], event.get("mask"))
+        if event["group"] in extents:
+            _merge_extent(extents[event["group"]], extent)
         else:
-            b = b["pixels"]
+            extents[event["group"]] = extent
+    return extents
+
+
+def _merge_extent(a, b):
+    np.minimum(a[:, 0], b[:, 0], out=a[:, 0])
+    np.maximum(a[:, 1], b[:, 1], out=a[:, 1])
 
-        out = np.empty(shape=a.shape)
-        for i in range(nchannels):
-            if b[i].size == 0:
-                out[i] = a[i]
+
+def _merge_minmax(extents_list):
+    merged = {}
+    for extents in extents_list:
+        for group, extent in extents.items():
+            if group in merged:
+                _merge_extent(merged[group], extent)
             else:
-                out[i, 0] = min(a[i, 0], np.min(b[i]))
-                out[i, 1] = max(a[i, 1], np.max(b[i]))
-        return out
-
-    def final_minmax(a, b):
-        out = np.empty(shape=a.shape)
-        for i in range(nchannels):
-            out[i, 0] = min(a[i, 0], b[i, 0])
-            out[i, 1] = max(a[i, 1], b[i, 1])
-        return out
-
-    init = np.empty(shape=(nchannels, 2))
-    init[:, 0] = np.inf
-    init[:, 1] = -np.inf
-    out = bag.foldby(
-        key="group",
-        binop=combine_extent_partition,
-        combine=final_minmax,
-        initial=init,
-        combine_initial=init
+                merged[group] = extent
+    return merged
+
+
+def _to_pairs(extents):
+    return list(extents.items())
+
+
+def get_distributed_minmax(bag, nchannels):
+    """
+    Compute the minimum and maximum of the (masked) pixels per group and channel. Each
+    partition reduces its events to one small array per group, and only these arrays are
+    combined across partitions.
+
+    Args:
+        bag (dask.bag): bag of dictionaries containing image data
+        nchannels (int): number of channels
+    Returns:
+        dask.bag.Item: list of (group, array of shape (nchannels, 2)) pairs
+    """
+    return bag.reduction(
+        perpartition=_partition_minmax,
+        aggregate=_merge_minmax
+    ).apply(_to_pairs)
+
+
+def _partition_sketches(part, nchannels, alpha):
+    sketches = {}
+    for event in part:
+        if "pixels" not in event:
+            continue
+        if event["group"] not in sketches:
+            sketches[event["group"]] = [QuantileSketch(alpha) for _ in range(nchannels)]
+        for i, sketch in enumerate(sketches[event["group"]]):
+            sketch.add(_channel_values(event, i))
+    return sketches
+
+
+def _merge_sketches(sketches_list):
+    merged = {}
+    for sketches in sketches_list:
+        for group, channels in sketches.items():
+            if group not in merged:
+                merged[group] = channels
+                continue
+            for a, b in zip(merged[group], channels):
+                a.merge(b)
+    return merged
+
+
+def get_distributed_sketches(bag, nchannels, alpha=0.005):
+    """
+    Accumulate a quantile sketch per group and channel of the (masked) pixel values
+
+    Args:
+        bag (dask.bag): bag of dictionaries containing image data
+        nchannels (int): number of channels
+        alpha (float): relative accuracy of the sketches
+    Returns:
+        dask.bag.Item: dictionary mapping each group to a list of sketches, one per channel
+    """
+    return bag.reduction(
+        perpartition=partial(_partition_sketches, nchannels=nchannels, alpha=alpha),
+        aggregate=_merge_sketches
     )
 
-    return out
+
+def sketch_quantiles(sketches, lower, upper):
+    """
+    Compute the lower and upper quantile per group and channel from sketches
+
+    Returns:
+        list: (group, array of shape (nchannels, 2)) pairs
+    """
+    return [
+        (group, np.array([[s.quantile(lower), s.quantile(upper)] for s in channels]))
+        for group, channels in sketches.items()
+    ]
+
+
+def _save_and_quantiles(sketches, lower, upper, path):
+    if path is not None:
+        save_sketches(sketches, path)
+    return sketch_quantiles(sketches, lower, upper)
+
+
+def save_statistics(quantiles, path, lower, upper):
+    """
+    Save the normalization bounds per group and channel in an npz file, to be restored by
+    load_statistics. Groups are stored as JSON, so that the file can be loaded without
+    unpickling.
+
+    Args:
+        quantiles (list): (group, array of shape (nchannels, 2)) pairs
+        path (Path): npz file
+        lower (float): lower quantile the bounds were estimated for
+        upper (float): upper quantile the bounds were estimated for
+    Returns:
+        list: quantiles
+    """
+    groups = [group for group, _ in quantiles]
+    np.savez(
+        path,
+        groups=np.array(json.dumps(groups)),
+        bounds=np.array([qq for _, qq in quantiles], dtype=float),
+        lower=np.array(lower),
+        upper=np.array(upper)
+    )
+    return quantiles
+
+
+def load_statistics(path):
+    """
+    Load normalization bounds saved with save_statistics
+
+    Args:
+        path (Path): npz file
+    Returns:
+        list: (group, array of shape (nchannels, 2)) pairs
+    """
+    with np.load(path) as data:
+        groups = json.loads(data["groups"].item())
+        return list(zip(groups, data["bounds"]))
+
+
+def bounds_lookup(quantiles):
+    """
+    Build a lookup from group to the lower bound and range of every channel, as float32
+
+    Args:
+        quantiles (list): (group, array of shape (nchannels, 2)) pairs
+    Returns:
+        dict: group to (lower, range) arrays of shape (nchannels,)
+    """
+    lookup = {}
+    for group, qq in quantiles:
+        lower = qq[:, 0].astype(np.float32)
+        lookup[group] = (lower, qq[:, 1].astype(np.float32) - lower)
+    return lookup
 
 
 @check
-def sample_normalization(sample, quantiles):
+def sample_normalization(sample, bounds, inplace=False):
     """
-    Perform min-max normalization using quantiles on original pixel data,
-    masked pixel data and flat masked intensities list
+    Perform min-max normalization of the pixel data, with one shift and scale broadcasted
+    over all channels
 
     Args:
         sample (dict): dictionary containing image data and mask data
-        qq: (lower, upper) list of quantiles for every channel
+        bounds (dict): lookup from group to lower bound and range, see bounds_lookup
+        inplace (bool): overwrite the pixels instead of allocating normalized pixels. Only
+            applies to writeable float32 pixels that own their memory, other pixels are always
+            copied to float32. Views, such as the crops of cells that share a tile, can overlap
+            and would otherwise be normalized more than once.
     Returns:
         dict: dictionary including normalized data
     """
 
-    qq = dict(quantiles)[sample["group"]]
+    if sample["group"] not in bounds:
+        raise ValueError(f"No normalization statistics for group {sample['group']}")
+    lower, extent = bounds[sample["group"]]
 
-    pixels = np.empty_like(sample["pixels"])
-    for i in range(len(sample["pixels"])):
-        pixels[i] = (sample["pixels"][i] - qq[i, 0]) / (qq[i, 1] - qq[i, 0])
+    pixels = sample["pixels"]
+    if not all([
+        inplace, pixels.dtype == np.float32, pixels.flags.writeable, pixels.flags.owndata
+    ]):
+        pixels = pixels.astype(np.float32)
+
+    shape = (-1,) + (1,) * (pixels.ndim - 1)
+    pixels -= lower.reshape(shape)
+    pixels /= extent.reshape(shape)
 
     newsample = copy_without(sample, without="pixels")
     newsample["pixels"] = pixels
@@ -89,21 +264,74 @@ def sample_normalization(sample, quantiles):
     return newsample
 
 
-def quantile_normalization(images: dask.bag.Bag, nchannels):
+def _normalize_partition(part, quantiles, inplace):
+    bounds = bounds_lookup(quantiles)
+    return [sample_normalization(p, bounds, inplace=inplace) for p in part]
+
+
+def _normalize(images, quantiles, inplace):
+    return images.map_partitions(_normalize_partition, quantiles, inplace=inplace)
+
+
+def quantile_normalization(
+    images: dask.bag.Bag,
+    lower: float,
+    upper: float,
+    nchannels: int,
+    alpha: float = 0.005,
+    sketches_path: Path = None,
+    statistics_path: Path = None,
+    inplace: bool = False
+):
     """
-    Apply min-max normalization on all images, both on original pixel data and masked pixel data
+    Apply quantile normalization on all images, both on original pixel data and masked pixel
+    data. Values at the lower quantile are mapped to 0, values at the upper quantile to 1.
+    The quantiles are estimated per group and channel with mergeable sketches, computed in one
+    pass over the images. With lower 0 and upper 1, the exact minimum and maximum are used.
 
     Args:
         images (dask.bag): bag of dictionaries containing image data
+        lower (float): lower quantile, in [0, 1]
+        upper (float): upper quantile, in [0, 1]
+        nchannels (int): number of channels
+        alpha (float): relative accuracy of the quantile estimates
+        sketches_path (Path): npz file to save the sketches in, for reuse in later runs
+        statistics_path (Path): npz file to save the bounds in, see transform
+        inplace (bool): overwrite float32 pixels, only safe if the pixels are not shared
     Returns:
         dask.bag: bag of dictionaries including normalized data
+        dask.delayed: list of (group, quantiles) pairs
     """
 
-    def normalize_partition(part, quantiles):
-        return [sample_normalization(p, quantiles) for p in part]
+    assert 0 <= lower < upper <= 1, "Quantiles must satisfy 0 <= lower < upper <= 1"
+
+    if (lower == 0) and (upper == 1):
+        quantiles = get_distributed_minmax(images, nchannels).to_delayed()
+    else:
+        sketches = get_distributed_sketches(images, nchannels, alpha=alpha).to_delayed()
+        quantiles = dask.delayed(_save_and_quantiles, pure=True)(
+            sketches, lower, upper, sketches_path)
 
-    quantiles = get_distributed_minmax(images, nchannels)
-    images = images.map_partitions(
-        normalize_partition, quantiles.to_delayed()[0])
+    if statistics_path is not None:
+        quantiles = dask.delayed(save_statistics, pure=True)(
+            quantiles, statistics_path, lower, upper)
 
-    return images, quantiles
+    return _normalize(images, quantiles, inplace), quantiles
+
+
+def transform(images: dask.bag.Bag, statistics_path: Path, inplace: bool = False):
+    """
+    Apply quantile normalization with bounds saved by an earlier quantile_normalization call,
+    without computing statistics over the images. Images of groups that are absent from the
+    saved bounds can not be normalized and raise an error.
+
+    Args:
+        images (dask.bag): bag of dictionaries containing image data
+        statistics_path (Path): npz file saved by quantile_normalization
+        inplace (bool): overwrite float32 pixels, only safe if the pixels are not shared
+    Returns:
+        dask.bag: bag of dictionaries including normalized data
+        dask.delayed: list of (group, quantiles) pairs
+    """
+    quantiles = dask.delayed(load_statistics, pure=True)(statistics_path)
+    return _normalize(images, quantiles, inplace), quantiles
@@ -0,0 +1,204 @@
+# Copyright (C) 2022 Maxim Lippeveld
+#
+# This file is part of SCIP.
+#
+# SCIP is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SCIP is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with SCIP.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Mergeable quantile sketches. Values are counted in logarithmically spaced bins, so that
+quantiles are estimated with a bounded relative error, as in DDSketch (Masson et al., 2019).
+The number of bins only depends on the dynamic range of the values, not on their number,
+and sketches of different partitions are merged by adding their counts.
+"""
+
+import json
+from typing import Any, List, Mapping
+from pathlib import Path
+
+import numpy
+
+
+class QuantileSketch:
+    """Sketch of the distribution of the values of one channel.
+
+    Positive values x are counted in bin ceil(log(x) / log(gamma)), negative values in the bin
+    of -x in a separate set of counts, and zeros separately. The bins are dense arrays that
+    start at an offset and grow as values are added.
+
+    Args:
+        alpha: Relative accuracy of the quantile estimates.
+    """
+
+    def __init__(self, alpha: float = 0.005):
+        self.alpha = alpha
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.log_gamma = numpy.log(self.gamma)
+
+        # smallest magnitude that is binned, smaller magnitudes are counted as zero
+        self.min_magnitude = 1e-9
+
+        self.counts = {1: numpy.zeros(0, dtype=numpy.int64), -1: numpy.zeros(0, dtype=numpy.int64)}
+        self.offsets = {1: 0, -1: 0}
+        self.zeros = 0
+        self.min = numpy.inf
+        self.max = -numpy.inf
+
+    @property
+    def count(self) -> int:
+        return int(self.counts[1].sum() + self.counts[-1].sum() + self.zeros)
+
+    def _add_counts(self, sign: int, offset: int, counts: numpy.ndarray) -> None:
+        if len(counts) == 0:
+            return
+        if len(self.counts[sign]) == 0:
+            self.counts[sign] = counts.astype(numpy.int64)
+            self.offsets[sign] = offset
+            return
+
+        lo = min(self.offsets[sign], offset)
+        hi = max(self.offsets[sign] + len(self.counts[sign]), offset + len(counts))
+        merged = numpy.zeros(hi - lo, dtype=numpy.int64)
+        start = self.offsets[sign] - lo
+        merged[start:start + len(self.counts[sign])] += self.counts[sign]
+        merged[offset - lo:offset - lo + len(counts)] += counts
+        self.counts[sign] = merged
+        self.offsets[sign] = lo
+
+    def add(self, values: numpy.ndarray) -> "QuantileSketch":
+        """Adds an array of values to the sketch, in one vectorized pass."""
+        values = numpy.asarray(values).ravel()
+        if values.size == 0:
+            return self
+
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+        magnitude = numpy.abs(values).astype(numpy.float64)
+        binned = magnitude > self.min_magnitude
+        self.zeros += int(values.size - numpy.count_nonzero(binned))
+
+        for sign in [1, -1]:
+            selected = binned & ((values > 0) if sign == 1 else (values < 0))
+            if not selected.any():
+                continue
+            index = numpy.ceil(numpy.log(magnitude[selected]) / self.log_gamma).astype(numpy.int64)
+            offset = int(index.min())
+            self._add_counts(sign, offset, numpy.bincount(index - offset))
+
+        return self
+
+    def merge(self, other: "QuantileSketch") -> "QuantileSketch":
+        """Adds the counts of another sketch with the same accuracy to this sketch."""
+        assert self.alpha == other.alpha, "Only sketches with equal accuracy can be merged"
+        for sign in [1, -1]:
+            self._add_counts(sign, other.offsets[sign], other.counts[sign])
+        self.zeros += other.zeros
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def _value(self, sign: int, index: int) -> float:
+        return sign * 2 * self.gamma ** index / (self.gamma + 1)
+
+    def quantile(self, q: float) -> float:
+        """Estimates the q-th quantile, with q in [0, 1]. The estimate is exact for q equal to
+        0 or 1, and otherwise within a relative error of alpha.
+        """
+        assert 0 <= q <= 1, "Quantile must be in [0, 1]"
+        n = self.count
+        if n == 0:
+            return numpy.nan
+        if q == 0:
+            return self.min
+        if q == 1:
+            return self.max
+
+        rank = q * (n - 1)
+
+        # negative values in ascending order are stored in descending bin order
+        negative = self.counts[-1][::-1]
+        cumsum = numpy.cumsum(negative)
+        if (len(cumsum) > 0) and (rank < cumsum[-1]):
+            i = int(numpy.searchsorted(cumsum, rank, side="right"))
+            index = self.offsets[-1] + len(negative) - 1 - i
+            return float(numpy.clip(self._value(-1, index), self.min, self.max))
+        rank -= cumsum[-1] if len(cumsum) > 0 else 0
+
+        if rank < self.zeros:
+            return 0.0
+        rank -= self.zeros
+
+        cumsum = numpy.cumsum(self.counts[1])
+        i = min(int(numpy.searchsorted(cumsum, rank, side="right")), len(cumsum) - 1)
+        return float(numpy.clip(self._value(1, self.offsets[1] + i), self.min, self.max))
+
+    def to_dict(self) -> Mapping[str, numpy.ndarray]:
+        """Returns the state of the sketch as arrays, for storage."""
+        return dict(
+            alpha=numpy.array(self.alpha),
+            positive_counts=self.counts[1],
+            positive_offset=numpy.array(self.offsets[1]),
+            negative_counts=self.counts[-1],
+            negative_offset=numpy.array(self.offsets[-1]),
+            zeros=numpy.array(self.zeros),
+            min=numpy.array(self.min),
+            max=numpy.array(self.max)
+        )
+
+    @classmethod
+    def from_dict(cls, state: Mapping[str, numpy.ndarray]) -> "QuantileSketch":
+        """Restores a sketch from the output of to_dict."""
+        sketch = cls(alpha=float(state["alpha"]))
+        sketch.counts = {
+            1: numpy.asarray(state["positive_counts"], dtype=numpy.int64),
+            -1: numpy.asarray(state["negative_counts"], dtype=numpy.int64)
+        }
+        sketch.offsets = {
+            1: int(state["positive_offset"]), -1: int(state["negative_offset"])}
+        sketch.zeros = int(state["zeros"])
+        sketch.min = float(state["min"])
+        sketch.max = float(state["max"])
+        return sketch
+
+
+def save_sketches(sketches: Mapping[Any, List[QuantileSketch]], path: Path) -> None:
+    """Saves sketches per group and channel in one npz file, to be restored by load_sketches.
+    Groups are stored as JSON, so that the file can be loaded without unpickling."""
+    arrays = {}
+    for i, (group, channels) in enumerate(sketches.items()):
+        arrays[f"{i}/group"] = numpy.array(json.dumps(group))
+        for j, sketch in enumerate(channels):
+            for k, v in sketch.to_dict().items():
+                arrays[f"{i}/{j}/{k}"] = v
+    numpy.savez(path, **arrays)
+
+
+def load_sketches(path: Path) -> Mapping[Any, List[QuantileSketch]]:
+    """Loads sketches saved with save_sketches."""
+    with numpy.load(path) as data:
+        states = {}
+        for name in data.files:
+            i, *rest = name.split("/")
+            states.setdefault(int(i), {})["/".join(rest)] = data[name]
+
+    sketches = {}
+    for i in sorted(states):
+        state = states[i]
+        group = json.loads(state.pop("group").item())
+        channels = {}
+        for name, v in state.items():
+            j, k = name.split("/")
+            channels.setdefault(int(j), {})[k] = v
+        sketches[group] = [QuantileSketch.from_dict(channels[j]) for j in sorted(channels)]
+    return sketches
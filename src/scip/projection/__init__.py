@@ -1,3 +1,11 @@
 
+def _project(event, proj, **proj_kw):
+    newevent = proj(event, **proj_kw)
+    if "pixels_lowres" in event:
+        newevent["pixels_lowres"] = proj(
+            dict(pixels=event["pixels_lowres"]), **proj_kw)["pixels"]
+    return newevent
+
+
 def project_block_partition(part, proj, **proj_kw):
-    return [proj(p, **proj_kw) for p in part]
+    return [_project(p, proj, **proj_kw) for p in part]
@@ -0,0 +1,128 @@
+# Copyright (C) 2022 Maxim Lippeveld
+#
+# This file is part of SCIP.
+#
+# SCIP is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SCIP is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with SCIP.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Best focus projection. Each Z plane is scored with the variance of its Laplacian, computed on a
+downsampled copy of the plane. Only the best k planes are kept, and combined into one plane.
+"""
+
+import numpy
+from typing import Any, Iterable, Mapping, Optional, Tuple, Union
+from scipy.ndimage import laplace
+
+from scip.projection.op import _OPS
+from scip.utils.util import copy_without
+
+
+def sharpness(
+    plane: numpy.ndarray,
+    downscale: int = 4,
+    channel: Optional[int] = None
+) -> Union[float, numpy.ndarray]:
+    """Scores the focus of a CXY plane as the variance of the Laplacian of the plane,
+    downsampled by taking every downscale-th pixel. Planes with leading dimensions, such as the
+    MCXY planes of a bulk read of tiles, are scored per index of those dimensions.
+
+    Args:
+        plane: CXY pixels of one Z plane, optionally preceded by other dimensions.
+        downscale: Downsampling factor applied before computing the Laplacian.
+        channel: Channel on which the score is computed. If None, the scores of all channels
+            are summed.
+    Returns:
+        Sharpness score, higher is sharper, or an array of scores shaped as the leading
+        dimensions.
+    """
+    if channel is not None:
+        plane = plane[..., [channel], :, :]
+    small = plane[..., ::downscale, ::downscale].astype(numpy.float32)
+
+    lead = small.shape[:-3]
+    scores = numpy.array([
+        sum(laplace(c).var() for c in p) for p in small.reshape((-1,) + small.shape[-3:])])
+    if len(lead) == 0:
+        return float(scores[0])
+    return scores.reshape(lead)
+
+
+def project_planes(
+    planes: Iterable[Union[numpy.ndarray, Tuple[numpy.ndarray, ...]]],
+    k: int = 1,
+    downscale: int = 4,
+    channel: Optional[int] = None,
+    op: str = "max"
+) -> Union[numpy.ndarray, Tuple[numpy.ndarray, ...]]:
+    """Keeps the k sharpest planes of a Z-stack given as an iterable of CXY planes, so that at
+    most k + 1 planes are held in memory. Planes with leading dimensions, such as tiles, are
+    projected per index of those dimensions.
+
+    The iterable may also yield tuples holding the same plane at several resolution levels. The
+    planes are then selected on the first level, and the same planes are kept for all levels.
+
+    Args:
+        planes: CXY planes of the Z-stack, or tuples of planes per resolution level.
+        k: Number of planes to keep.
+        downscale: Downsampling factor used for scoring, see sharpness.
+        channel: Channel used for scoring, see sharpness.
+        op: Operation combining the best planes if k > 1 (one of max, mean).
+    Returns:
+        Best plane, or the combination of the k best planes, or a tuple of these per level.
+    """
+    assert k >= 1, "At least one plane has to be kept"
+    assert op in _OPS, f"Combining operation must be one of {list(_OPS.keys())}"
+
+    best, scores, n = None, None, 0
+    for plane in planes:
+        levels = plane if isinstance(plane, tuple) else (plane,)
+        score = numpy.reshape(sharpness(levels[0], downscale=downscale, channel=channel), -1)
+        if best is None:
+            lead = levels[0].shape[:-3]
+            best = [numpy.empty((k,) + level.shape, dtype=level.dtype) for level in levels]
+            scores = numpy.full((k, len(score)), -numpy.inf)
+
+        # the first k planes fill the empty slots in order, later planes replace the worst
+        for i, s in enumerate(score):
+            worst = numpy.argmin(scores[:, i])
+            if s > scores[worst, i]:
+                scores[worst, i] = s
+                index = numpy.unravel_index(i, lead)
+                for b, level in zip(best, levels):
+                    b[worst][index] = level[index]
+        n += 1
+
+    # a leading axis puts the planes on the second axis, on which the operations reduce
+    n = min(n, k)
+    projected = tuple(
+        b[0] if n == 1 else _OPS[op](b[:n][numpy.newaxis])[0] for b in best)
+    return projected if isinstance(plane, tuple) else projected[0]
+
+
+def project_block(
+    event: Mapping[str, Any],
+    **kwargs
+) -> Mapping[str, Any]:
+    """Performs best focus projection of multi focal pixel data.
+
+    Args:
+        kwargs: Settings passed to project_planes.
+    Returns:
+        Events with projected pixels.
+    """
+    newevent = copy_without(event, without=["pixels"])
+    pixels = event["pixels"]
+    newevent["pixels"] = project_planes((pixels[:, z] for z in range(pixels.shape[1])), **kwargs)
+
+    return newevent
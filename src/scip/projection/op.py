@@ -16,7 +16,7 @@
 # along with SCIP.  If not, see <http://www.gnu.org/licenses/>.
 
 import numpy
-from typing import Any, Callable, Mapping
+from typing import Any, Callable, Iterable, Mapping, Tuple, Union
 from functools import partial
 
 from scip.utils.util import copy_without
@@ -24,7 +24,7 @@ from scip.utils.util import copy_without
 
 _OPS: Mapping[str, Callable[[numpy.ndarray], numpy.ndarray]] = {
     "max": partial(numpy.max, axis=1),
-    "mean": partial(numpy.mean, axis=1)
+    "mean": partial(numpy.mean, axis=1, dtype=numpy.float32)
 }
 
 
@@ -43,3 +43,44 @@ def project_block(
     newevent["pixels"] = _OPS[op](event["pixels"])
 
     return newevent
+
+
+def project_planes(
+    planes: Iterable[Union[numpy.ndarray, Tuple[numpy.ndarray, ...]]],
+    op: str
+) -> Union[numpy.ndarray, Tuple[numpy.ndarray, ...]]:
+    """Performs Z-stack projection on planes that are produced one at a time, so that only the
+    accumulator and the current plane are held in memory. Loaders use this to fuse projection
+    into reading.
+
+    Args:
+        planes: CXY planes of the Z-stack, or tuples of planes per resolution level.
+        op: Projection operation to be performed (one of max, mean).
+    Returns:
+        Projected pixels, equal to the result of project_block on the full stack, or a tuple
+        of these per level.
+    """
+    assert op in _OPS, f"Projection operation must be one of {list(_OPS.keys())}"
+
+    planes = iter(planes)
+    first = next(planes)
+    # tuples hold the same plane at several resolution levels, which are projected separately
+    levels = isinstance(first, tuple)
+    first = first if levels else (first,)
+
+    if op == "max":
+        accs = [f.copy() for f in first]
+        for plane in planes:
+            for acc, p in zip(accs, plane if levels else (plane,)):
+                numpy.maximum(acc, p, out=acc)
+    else:
+        accs = [f.astype(numpy.float32) for f in first]
+        n = 1
+        for plane in planes:
+            for acc, p in zip(accs, plane if levels else (plane,)):
+                numpy.add(acc, p, out=acc)
+            n += 1
+        for acc in accs:
+            acc /= n
+
+    return tuple(accs) if levels else accs[0]
@@ -5,7 +5,7 @@ import numpy
 import dask
 import dask.bag
 from skimage.measure import regionprops
-from scip.utils.util import copy_without
+from scip.utils.util import copy_without, to_lowres_partition, to_fullres_partition
 
 
 def _substract_mask(event, left_index, right_index, for_channel_index):
@@ -21,11 +21,17 @@ def segment(
     export: bool,
     output: Path,
     gpu: bool,
-    loader_module
+    loader_module,
+    lowres: bool = False
 ) -> dask.bag.Bag:
 
     mod = import_module('scip.segmentation.%s' % method)
 
+    # segmentation can run on the low resolution pixels of a multiscale image, the labeled
+    # masks are upscaled to the full resolution afterwards
+    if lowres:
+        images = images.map_partitions(to_lowres_partition)
+
     # this segment operation is annotated with the cellpose resource to let the scheduler
     # know that it should only be executed on a worker that also has the cellpose resource.
     if gpu > 0:
@@ -34,6 +40,9 @@ def segment(
     else:
         images = images.map_partitions(mod.segment_block, gpu_accelerated=False, **settings)
 
+    if lowres:
+        images = images.map_partitions(to_fullres_partition)
+
     if settings["substract"] is not None:
         images = images.map(
             _substract_mask,
@@ -101,7 +110,7 @@ def to_events(
             for m in mask:
                 regions.append(int(m.any()))
 
-            newevent = copy_without(event=event, without=["mask", "pixels"])
+            newevent = copy_without(event=event, without=["mask", "pixels", "pixels_lowres"])
             newevent["pixels"] = event["pixels"][:, bbox[0]: bbox[2], bbox[1]:bbox[3]]
             newevent["combined_mask"] = combined_mask
             newevent["mask"] = mask
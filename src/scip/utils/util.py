@@ -26,9 +26,16 @@ import shutil
 import click
 from datetime import datetime, timedelta
 import dask
+import numpy
+import psutil
 from scip._version import get_versions
 
 MODES = ["local", "jobqueue", "mpi", "external", "debug"]
+DTYPES = ["native", "float32"]
+
+# share of the memory available to one worker thread that the pixels of a partition may take up,
+# the remainder is used by masks, intermediate copies and features
+PARTITION_MEMORY_FRACTION = 0.1
 
 
 class ClientClusterContext:
@@ -208,6 +215,93 @@ def check(func):
     return inner
 
 
+@check
+def enforce_dtype(event, dtype):
+    """Casts pixels according to the pipeline dtype policy. With the native policy, integer
+    pixels are kept as is and only float64 pixels are reduced to float32. With the float32
+    policy, all pixels are cast to float32.
+
+    Args:
+        event: Event with pixels.
+        dtype: One of DTYPES.
+
+    Returns:
+        Event with pixels in the dtype prescribed by the policy.
+    """
+    pixels = event["pixels"]
+    if (dtype == "native") and (pixels.dtype != numpy.float64):
+        return event
+    if pixels.dtype == numpy.float32:
+        return event
+
+    newevent = event.copy()
+    newevent["pixels"] = pixels.astype(numpy.float32)
+    return newevent
+
+
+def enforce_dtype_partition(partition, dtype):
+    return [enforce_dtype(event, dtype) for event in partition]
+
+
+def to_lowres(event):
+    """Swaps in the pixels_lowres loaded from a coarser pyramid level, so that the next step
+    (masking or segmentation) runs on fewer pixels. The full resolution pixels are kept aside
+    and restored by to_fullres. Events without low resolution pixels are returned as is.
+    """
+    if ("pixels" not in event) or ("pixels_lowres" not in event):
+        return event
+
+    newevent = copy_without(event, without=["pixels", "pixels_lowres"])
+    newevent["pixels"] = event["pixels_lowres"]
+    newevent["pixels_fullres"] = event["pixels"]
+    return newevent
+
+
+def to_fullres(event):
+    """Restores the full resolution pixels set aside by to_lowres and upscales the mask to the
+    full resolution with nearest neighbour interpolation, keeping its dtype.
+    """
+    if "pixels_fullres" not in event:
+        return event
+
+    newevent = copy_without(event, without=["pixels", "pixels_fullres"])
+    if "pixels" not in event:
+        # event was filtered out
+        return newevent
+
+    newevent["pixels"] = event["pixels_fullres"]
+    if "mask" in event:
+        from skimage.transform import resize
+
+        mask = event["mask"]
+        shape = mask.shape[:-2] + event["pixels_fullres"].shape[-2:]
+        newevent["mask"] = resize(
+            mask, shape, order=0, preserve_range=True, anti_aliasing=False).astype(mask.dtype)
+    return newevent
+
+
+def to_lowres_partition(partition):
+    return [to_lowres(event) for event in partition]
+
+
+def to_fullres_partition(partition):
+    return [to_fullres(event) for event in partition]
+
+
+def partition_budget(client, fraction=PARTITION_MEMORY_FRACTION):
+    """Returns the byte budget for the pixels of one partition and the total number of threads
+    in the cluster. The budget is a fraction of the memory of the smallest worker, divided over
+    its threads, as each thread processes one partition at a time.
+    """
+    workers = client.scheduler_info()["workers"].values()
+
+    budget = min(
+        (w["memory_limit"] or psutil.virtual_memory().total) / w["nthreads"]
+        for w in workers
+    )
+    return int(budget * fraction), sum(w["nthreads"] for w in workers)
+
+
 def prerun(context, paths, output, headless, debug, mode, gpu, n_partitions, n_threads):
 
     make_output_dir(output, headless=headless)
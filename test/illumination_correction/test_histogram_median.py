@@ -0,0 +1,21 @@
+import pytest
+import numpy
+from scipy.ndimage import median_filter
+from scip.illumination_correction import histogram_median
+
+
+@pytest.mark.parametrize("size", [1, 4, 5, 11])
+def test_median_filter(size):
+    image = numpy.random.default_rng(0).integers(0, 256, size=(30, 40)).astype(numpy.float32)
+
+    out = histogram_median.median_filter(image, size=size, bins=256)
+
+    assert out.shape == image.shape
+    assert out.dtype == numpy.float32
+    # values are quantized in bins of width one
+    assert numpy.abs(out - median_filter(image, size=size)).max() <= 0.5 + 1e-4
+
+
+def test_median_filter_constant():
+    image = numpy.full((10, 10), 3, dtype=numpy.uint16)
+    assert (histogram_median.median_filter(image, size=5) == 3).all()
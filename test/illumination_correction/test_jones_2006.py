@@ -1,19 +1,28 @@
 import pytest
 import numpy
 import pickle
+import dask.bag
 from scip.illumination_correction import jones_2006
 
 
+def _load(path):
+    store = jones_2006.CorrectionStore(path)
+    return {group: numpy.asarray(store[group]) for group in store.files}
+
+
+@pytest.mark.parametrize("median_filter_mode", ["exact", "histogram"])
+@pytest.mark.parametrize("downscale", [1, 3])
 @pytest.mark.parametrize("fake_images_bag", [False], indirect=True)
-def test_correct(fake_images_bag, tmp_path):
+def test_correct(fake_images_bag, tmp_path, downscale, median_filter_mode):
 
     images = jones_2006.correct(
         images=fake_images_bag,
         key="group",
         median_filter_size=11,
-        downscale=1,
+        median_filter_mode=median_filter_mode,
+        downscale=downscale,
         output=tmp_path,
-        ngroups=1
+        groups=dask.bag.from_sequence(["one", "two", "absent"])
     )
 
     original_images = fake_images_bag.compute()
@@ -29,8 +38,60 @@ def test_correct(fake_images_bag, tmp_path):
         for im1, im2 in zip(original_images, a)
     )
 
-    assert (tmp_path / "correction_images.pickle").exists()
+    assert (tmp_path / "correction_images").exists()
 
-    with open(tmp_path / "correction_images.pickle", "rb") as fh:
-        corr = pickle.load(fh)
+    corr = _load(tmp_path / "correction_images")
+    assert set(corr.keys()) == set(im["group"] for im in original_images)
     assert all(~(v == 1).all() for _, v in corr.items())
+    assert all(v.shape == (3, 10, 10) for _, v in corr.items())
+
+
+@pytest.mark.parametrize("fake_images_bag", [False], indirect=True)
+def test_correct_precomputed(fake_images_bag, tmp_path):
+    groups = dask.bag.from_sequence(["one", "two"])
+    kwargs = dict(images=fake_images_bag, key="group", median_filter_size=11, groups=groups)
+    expected = jones_2006.correct(output=tmp_path, **kwargs).compute(optimize_graph=False)
+
+    store = jones_2006.correct(precomputed=tmp_path / "correction_images", **kwargs).compute()
+
+    corr = _load(tmp_path / "correction_images")
+    with open(tmp_path / "correction_images.pickle", "wb") as fh:
+        pickle.dump(corr, fh)
+    legacy = jones_2006.correct(precomputed=tmp_path / "correction_images.pickle", **kwargs)
+    legacy = legacy.compute()
+
+    for a, b, c in zip(expected, store, legacy):
+        assert numpy.array_equal(a["pixels"], b["pixels"])
+        assert numpy.array_equal(a["pixels"], c["pixels"])
+
+
+def test_save_correction_images_groups(tmp_path):
+    groups = [1, "1", str(tmp_path / "elsewhere" / "image"), "a/b"]
+    images = {g: numpy.full((1, 2, 2), i, dtype=numpy.float32) for i, g in enumerate(groups)}
+    jones_2006.save_correction_images(images, tmp_path)
+
+    assert len(list(tmp_path.glob("correction_images/*.npy"))) == len(groups)
+    store = jones_2006.CorrectionStore(tmp_path / "correction_images")
+    for group, image in images.items():
+        assert numpy.array_equal(store[group], image)
+
+
+@pytest.mark.parametrize("downscale", [1, 2, 3])
+def test_accumulate_downscaled(downscale):
+    rng = numpy.random.default_rng(0)
+    images = [dict(pixels=rng.integers(0, 100, size=(2, 10, 10), dtype=numpy.uint16))
+              for _ in range(5)]
+
+    total1 = dict(pixels=None, count=0)
+    for im in images[:3]:
+        total1 = jones_2006._binop(total1, im, downscale=downscale)
+    total2 = dict(pixels=None, count=0)
+    for im in images[3:]:
+        total2 = jones_2006._binop(total2, im, downscale=downscale)
+    total = jones_2006._combine(total1, total2)
+
+    expected = numpy.mean([jones_2006._downscale(im["pixels"], downscale) for im in images], axis=0)
+    assert total["pixels"].dtype == numpy.float32
+    assert total["count"] == 5
+    assert total["shape"] == (2, 10, 10)
+    assert numpy.allclose(total["pixels"] / total["count"], expected)
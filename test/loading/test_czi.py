@@ -17,12 +17,97 @@
 
 import os
 import pytest
+from functools import partial
+from types import SimpleNamespace
+import numpy
+import dask.array
 import dask.bag
 from scip.loading import czi
+from scip.loading import util as l_util
 from scip.segmentation import export_labeled_mask, to_events
 from scip.projection import op, project_block_partition
 
 
+class FakeCzi:
+    """Stands in for AICSImage on a CZI file and records the size of every decode. Like the
+    CziReader, each chunk of the lazy array is decoded with a separate read.
+    """
+
+    shape = dict(T=1, M=3, C=2, Z=4, Y=6, X=5)
+    decodes = []
+
+    def __init__(self, path, reconstruct_mosaic=True, chunk_dims=("Z", "Y", "X")):
+        self.chunk_dims = set(chunk_dims) | {"Y", "X"}
+        self.dims = SimpleNamespace(order="".join(self.shape), **self.shape)
+        self.dtype = numpy.dtype(numpy.uint16)
+        self.scene = None
+
+    def set_scene(self, scene):
+        self.scene = scene
+
+    def _decode(self, block):
+        if block.size > 0:
+            FakeCzi.decodes.append(block.size)
+        return block
+
+    def _pixels(self):
+        size = numpy.prod(list(self.shape.values()))
+        pixels = numpy.arange(size, dtype=self.dtype) + int(self.scene[1:])
+        return pixels.reshape(list(self.shape.values()))
+
+    def _select(self, data, order, selection):
+        dims = list(self.shape)
+        for dim, index in selection.items():
+            i = dims.index(dim)
+            data = data[(slice(None),) * i + (index,)]
+            if isinstance(index, int):
+                dims.pop(i)
+        return data.transpose([dims.index(d) for d in order])
+
+    def get_image_dask_data(self, order, **selection):
+        chunks = [n if d in self.chunk_dims else 1 for d, n in self.shape.items()]
+        data = dask.array.from_array(self._pixels(), chunks=chunks)
+        data = data.map_blocks(self._decode, meta=numpy.array((), dtype=self.dtype))
+        return self._select(data, order, selection)
+
+    def get_image_data(self, order, **selection):
+        return self._select(self._decode(self._pixels()), order, selection)
+
+
+@pytest.fixture
+def fake_czi(monkeypatch):
+    monkeypatch.setattr(FakeCzi, "decodes", [])
+    monkeypatch.setattr(czi, "AICSImage", FakeCzi)
+    monkeypatch.setattr(czi, "_readers", l_util.ReaderCache(factory=czi._open))
+    return FakeCzi
+
+
+def test_load_scene_partition_reads_scene_once(fake_czi):
+    partition = [dict(path="a.czi", scene=s, tile=t) for s in ["S0", "S1"] for t in [0, 2]]
+    expected = [czi._load_block(e, channels=[1], reader_cache_size=2) for e in partition]
+
+    fake_czi.decodes.clear()
+    loaded = czi._load_scene_partition(partition, channels=[1], reader_cache_size=2)
+
+    assert len(fake_czi.decodes) == 2
+    for a, b in zip(expected, loaded):
+        assert (a["scene"], a["tile"]) == (b["scene"], b["tile"])
+        assert b["pixels"].shape == (1, 4, 5, 6)
+        assert numpy.array_equal(a["pixels"], b["pixels"])
+
+
+@pytest.mark.parametrize("scene_bulk_read", [False, True])
+def test_load_pixels_project_decodes_planes(fake_czi, scene_bulk_read):
+    meta = dask.bag.from_sequence([dict(path="a.czi", scene="S0", tile=1)], npartitions=1)
+    images = czi.load_pixels(
+        images=meta, channels=[0], scene_bulk_read=scene_bulk_read,
+        project=partial(op.project_planes, op="max"))
+    images = images.compute(scheduler="synchronous")
+
+    assert images[0]["pixels"].shape == (1, 5, 6)
+    assert fake_czi.decodes == [6 * 5] * 4
+
+
 @pytest.mark.parametrize("channels, expected_length", [(None, 7), ([0, 6], 2)])
 def test_load_pixels(czi_path, channels, expected_length):
     pytest.importorskip("aicspylibczi")
@@ -35,6 +120,19 @@ def test_load_pixels(czi_path, channels, expected_length):
     assert all(len(im["pixels"]) == expected_length for im in images)
 
 
+def test_load_pixels_scene_bulk_read(czi_path):
+    pytest.importorskip("aicspylibczi")
+    meta = czi.meta_from_directory(path=czi_path, scenes=None)
+    meta = dask.bag.from_delayed(meta)
+    images = czi.load_pixels(images=meta, channels=[0, 6]).compute()
+    bulk_images = czi.load_pixels(images=meta, channels=[0, 6], scene_bulk_read=True).compute()
+
+    assert len(images) == len(bulk_images)
+    for a, b in zip(images, bulk_images):
+        assert (a["scene"], a["tile"]) == (b["scene"], b["tile"])
+        assert numpy.array_equal(a["pixels"], b["pixels"])
+
+
 @pytest.mark.parametrize("projection", ["mean", "max"])
 def test_project(czi_path, projection):
     pytest.importorskip("aicspylibczi")
@@ -48,6 +146,22 @@ def test_project(czi_path, projection):
     assert all(len(im["pixels"].shape) == 3 for im in images)
 
 
+@pytest.mark.parametrize("scene_bulk_read", [False, True])
+@pytest.mark.parametrize("projection", ["mean", "max"])
+def test_load_pixels_project(czi_path, projection, scene_bulk_read):
+    pytest.importorskip("aicspylibczi")
+    meta = czi.meta_from_directory(path=czi_path, scenes=None)
+    meta = dask.bag.from_delayed(meta)
+    images = czi.load_pixels(images=meta, channels=[0, 6]).map(op.project_block, op=projection)
+    fused = czi.load_pixels(
+        images=meta, channels=[0, 6], scene_bulk_read=scene_bulk_read,
+        project=partial(op.project_planes, op=projection))
+
+    for a, b in zip(images.compute(), fused.compute()):
+        assert a["pixels"].shape == b["pixels"].shape
+        assert numpy.allclose(a["pixels"], b["pixels"])
+
+
 @pytest.mark.skipif(
     "GITHUB_ACTIONS" in os.environ,
     reason="Bug in CellPose package related to CPNet on CPU"
@@ -16,6 +16,9 @@
 # along with SCIP.  If not, see <http://www.gnu.org/licenses/>.
 
 from pathlib import Path
+import pytest
+import numpy
+import dask.bag
 from scip.loading import multiframe_tiff
 
 
@@ -29,10 +32,13 @@ def test_load_image(image_path: Path):
     assert im["pixels"].mean() > 0
 
 
-def test_bag_from_directory(images_folder):
-    bag, meta = multiframe_tiff.bag_from_directory(
-        images_folder, channels=None, partition_size=2)
-    images = bag.compute()
+@pytest.mark.parametrize("channels, expected_length", [(None, 8), ([0, 2], 2), ([1], 1)])
+def test_load_pixels(images_folder, channels, expected_length):
+    images = multiframe_tiff.meta_from_directory(path=images_folder)
+    images = dask.bag.from_delayed(images)
+    images = multiframe_tiff.load_pixels(images=images, channels=channels)
+    images = images.compute()
+
     assert len(images) == 11
-    assert len(images) == len(meta)
-    assert all(len(im["pixels"]) == 8 for im in images)
+    assert all(len(im["pixels"]) == expected_length for im in images)
+    assert all(im["pixels"].dtype == numpy.float32 for im in images)
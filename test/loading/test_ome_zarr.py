@@ -0,0 +1,134 @@
+# Copyright (C) 2022 Maxim Lippeveld
+#
+# This file is part of SCIP.
+#
+# SCIP is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SCIP is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with SCIP.  If not, see <http://www.gnu.org/licenses/>.
+
+from scip.loading import ome_zarr
+from scip.projection import op, focus
+import os
+import zarr
+import numpy
+import pytest
+from functools import partial
+import dask.bag
+
+
+def _write_image(path, data, axes):
+    group = zarr.open_group(str(path), mode="w")
+    datasets = []
+    for level in range(3):
+        step = 2 ** level
+        group.create_dataset(str(level), data=data[..., ::step, ::step], chunks=False)
+        datasets.append(dict(path=str(level)))
+    group.attrs["multiscales"] = [dict(
+        version="0.4", axes=[dict(name=a) for a in axes], datasets=datasets)]
+
+
+@pytest.fixture
+def ome_zarr_path(tmp_path):
+    # axes are ordered tczyx, as prescribed by the specification
+    rng = numpy.random.default_rng(0)
+    for name in ["A", "B"]:
+        data = rng.integers(0, 1000, size=(2, 3, 4, 32, 48), dtype=numpy.uint16)
+        _write_image(tmp_path / f"{name}.zarr", data, "tczyx")
+    return tmp_path
+
+
+@pytest.mark.parametrize("channels, expected_length", [(None, 3), ([0, 2], 2)])
+def test_load_pixels(ome_zarr_path, channels, expected_length):
+    images = dask.bag.from_delayed(ome_zarr.meta_from_directory(
+        path=str(ome_zarr_path), regex="(?P<well>[AB]).zarr"))
+    images = ome_zarr.load_pixels(images=images, channels=channels, mask_level=2)
+    images = images.compute()
+
+    assert len(images) == 4
+    assert sorted((im["well"], im["t"]) for im in images) == \
+        [("A", 0), ("A", 1), ("B", 0), ("B", 1)]
+    for im in images:
+        z = zarr.open_array(str(ome_zarr_path / f"{im['name']}.zarr" / "0"), mode="r")
+        expected = z[im["t"]] if channels is None else z[im["t"]][channels]
+
+        assert im["pixels"].shape == (expected_length, 4, 48, 32)
+        assert numpy.array_equal(im["pixels"], numpy.swapaxes(expected, -1, -2))
+        assert im["pixels_lowres"].shape == (expected_length, 4, 12, 8)
+
+
+@pytest.mark.parametrize("projection", ["mean", "max"])
+def test_load_pixels_project(ome_zarr_path, projection):
+    meta = dask.bag.from_delayed(ome_zarr.meta_from_directory(path=str(ome_zarr_path)))
+    images = ome_zarr.load_pixels(images=meta, channels=None, mask_level=1)
+    images = images.map(op.project_block, op=projection).compute()
+    fused = ome_zarr.load_pixels(
+        images=meta, channels=None, mask_level=1,
+        project=partial(op.project_planes, op=projection)).compute()
+
+    for a, b in zip(images, fused):
+        assert b["pixels"].shape == (3, 48, 32)
+        assert b["pixels_lowres"].shape == (3, 24, 16)
+        assert b["pixels"].dtype == a["pixels"].dtype
+        assert numpy.allclose(a["pixels"], b["pixels"])
+
+
+def test_load_pixels_focus_levels(ome_zarr_path):
+    meta = dask.bag.from_delayed(ome_zarr.meta_from_directory(path=str(ome_zarr_path)))
+    images = ome_zarr.load_pixels(images=meta, channels=None, mask_level=1)
+    fused = ome_zarr.load_pixels(
+        images=meta, channels=None, mask_level=1,
+        project=partial(focus.project_planes, k=1, downscale=1)).compute()
+
+    # the plane selected at full resolution is kept at the mask level as well
+    for a, b in zip(images.compute(), fused):
+        z = [i for i in range(4) if numpy.array_equal(a["pixels"][:, i], b["pixels"])]
+        assert len(z) == 1
+        assert numpy.array_equal(a["pixels_lowres"][:, z[0]], b["pixels_lowres"])
+
+
+def test_load_pixels_without_optional_axes(tmp_path):
+    data = numpy.arange(32 * 48, dtype=numpy.uint8).reshape(32, 48)
+    _write_image(tmp_path / "image.zarr", data, "yx")
+
+    images = dask.bag.from_delayed(ome_zarr.meta_from_directory(path=str(tmp_path / "image.zarr")))
+    images = ome_zarr.load_pixels(images=images, channels=None).compute()
+
+    assert len(images) == 1
+    assert "pixels_lowres" not in images[0]
+    assert numpy.array_equal(images[0]["pixels"], data.T[numpy.newaxis])
+
+
+def test_estimate_nbytes(ome_zarr_path):
+    partition = ome_zarr.meta_from_directory(path=str(ome_zarr_path)).compute()
+    assert ome_zarr.estimate_nbytes(partition, channels=[0]) == 4 * 4 * 32 * 48 * 2
+
+
+def test_manifest_new_timepoints(tmp_path):
+    data = numpy.zeros((2, 1, 1, 8, 8), dtype=numpy.uint8)
+    _write_image(tmp_path / "images" / "A.zarr", data, "tczyx")
+    manifest = str(tmp_path / "manifest")
+
+    def scan():
+        return ome_zarr.meta_from_directory(str(tmp_path / "images"), manifest=manifest).compute()
+
+    assert len(scan()) == 2
+
+    # timepoints are appended inside the image, so the mtime of the directory is unchanged
+    mtime = os.stat(tmp_path / "images").st_mtime_ns
+    group = zarr.open_group(str(tmp_path / "images" / "A.zarr"), mode="a")
+    for level in ["0", "1", "2"]:
+        group[level].append(group[level][:1], axis=0)
+        path = tmp_path / "images" / "A.zarr" / level / ".zarray"
+        os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1))
+    os.utime(tmp_path / "images", ns=(0, mtime))
+
+    assert len(scan()) == 3
@@ -1,10 +1,13 @@
-from scip.loading import tiff
+import shutil
+from scip.loading import tiff, load_meta
 import dask.bag
+import numpy
 import pytest
 
 
+@pytest.mark.parametrize("reader", ["tifffile", "aicsimageio"])
 @pytest.mark.parametrize("channels, expected_length", [([1], 1), ([1, 2], 2)])
-def test_load_pixels(tiffs_folder, channels, expected_length):
+def test_load_pixels(tiffs_folder, channels, expected_length, reader):
     images = tiff.meta_from_directory(
         path=tiffs_folder,
         regex="^.+/test(?P<id>.+)_(?P<channel>[0-9]).+$"
@@ -13,9 +16,54 @@ def test_load_pixels(tiffs_folder, channels, expected_length):
     images = tiff.load_pixels(
         images=images,
         channels=channels,
-        regex="^.+/test(?P<id>.+)_(?P<channel>[0-9]).+$"
+        regex="^.+/test(?P<id>.+)_(?P<channel>[0-9]).+$",
+        reader=reader
     )
     images = images.compute()
 
     assert len(images) > 0
     assert all(len(im["pixels"]) == expected_length for im in images)
+
+
+def test_readers_equal(tiffs_folder):
+    regex = "^.+/test(?P<id>.+)_(?P<channel>[0-9]).+$"
+    meta = dask.bag.from_delayed(tiff.meta_from_directory(path=tiffs_folder, regex=regex))
+
+    a = tiff.load_pixels(meta, channels=[1, 2], regex=regex, reader="tifffile").compute()
+    b = tiff.load_pixels(meta, channels=[1, 2], regex=regex, reader="aicsimageio").compute()
+
+    assert len(a) == len(b)
+    for im1, im2 in zip(a, b):
+        assert im1["pixels"].dtype == im2["pixels"].dtype
+        assert numpy.array_equal(im1["pixels"], im2["pixels"])
+
+
+def test_load_meta_subdirectories(tiffs_folder, tmp_path):
+    for plate in ["plate1", "plate2"]:
+        (tmp_path / plate).mkdir()
+        for f in tiffs_folder.iterdir():
+            shutil.copy(f, tmp_path / plate / f.name)
+
+    regex = r"^.+\/(?P<plate>.+)\/test(?P<id>.+)_(?P<channel>[0-9]).+$"
+    meta = load_meta(
+        paths=[str(tmp_path)],
+        kwargs=dict(regex=regex, subdirectories=True),
+        loader_module=tiff
+    )
+
+    assert meta.npartitions == 2
+    events = meta.compute()
+    assert len(events) == 4
+    assert sorted(e["plate"] for e in events) == ["plate1", "plate1", "plate2", "plate2"]
+
+
+def test_get_shards_root_files(tiffs_folder, tmp_path):
+    (tmp_path / "plate1").mkdir()
+    assert tiff.get_shards(str(tmp_path), subdirectories=True) == [str(tmp_path / "plate1")]
+
+    shutil.copy(next(tiffs_folder.glob("*.tif*")), tmp_path)
+    assert tiff.get_shards(str(tmp_path), subdirectories=True) == \
+        [str(tmp_path), str(tmp_path / "plate1")]
+
+    with pytest.raises(AssertionError):
+        tiff.get_shards(str(tmp_path / "plate1"), subdirectories=True)
@@ -0,0 +1,98 @@
+import os
+import time
+import pytest
+from scip.loading.util import (
+    ReaderCache, cached_scan, directories, itemsize, _load_image_partition, prefetch_info)
+
+
+def test_reader_cache():
+    opened = []
+
+    def factory(path):
+        opened.append(path)
+        return object()
+
+    cache = ReaderCache(factory=factory)
+
+    reader, _ = cache.get("a", capacity=2)
+    assert cache.get("a", capacity=2)[0] is reader
+    cache.get("b", capacity=2)
+    cache.get("c", capacity=2)  # evicts a
+    cache.get("a", capacity=2)
+
+    assert opened == ["a", "b", "c", "a"]
+    assert cache.info() == dict(hits=1, misses=4, evictions=2, size=2)
+
+
+def test_cached_scan(tmp_path):
+    data = tmp_path / "data"
+    data.mkdir()
+    scans = []
+
+    def scan():
+        scans.append(1)
+        return [dict(path=str(p), id=i) for i, p in enumerate(sorted(data.iterdir()))]
+
+    (data / "a.tiff").touch()
+    events = cached_scan(data, scan, str(tmp_path / "manifest"), regex="a")
+    assert cached_scan(data, scan, str(tmp_path / "manifest"), regex="a") == events
+    assert len(scans) == 1
+
+    # other parameters use another manifest
+    cached_scan(data, scan, str(tmp_path / "manifest"), regex="b")
+    assert len(scans) == 2
+
+    # a new file changes the directory mtime, triggering a rescan
+    (data / "b.tiff").touch()
+    os.utime(data, ns=(0, os.stat(data).st_mtime_ns + 1))
+    events = cached_scan(data, scan, str(tmp_path / "manifest"), regex="a")
+    assert len(scans) == 3
+    assert len(events) == 2
+
+
+def test_cached_scan_subdirectories(tmp_path):
+    data = tmp_path / "data"
+    (data / "sub").mkdir(parents=True)
+    scans = []
+
+    def scan():
+        scans.append(1)
+        return [dict(path=str(p)) for p in sorted(data.glob("**/*.tiff"))]
+
+    def cached():
+        return cached_scan(
+            data, scan, str(tmp_path / "manifest"), stamp_paths=lambda: directories(data))
+
+    (data / "sub" / "a.tiff").touch()
+    assert len(cached()) == 1
+
+    # a new file in a subdirectory leaves the mtime of data unchanged
+    mtime = os.stat(data).st_mtime_ns
+    (data / "sub" / "b.tiff").touch()
+    os.utime(data / "sub", ns=(0, os.stat(data / "sub").st_mtime_ns + 1))
+    os.utime(data, ns=(0, mtime))
+
+    assert len(cached()) == 2
+    assert len(scans) == 2
+
+
+@pytest.mark.parametrize("prefetch", [0, 1, 4])
+def test_load_image_partition_prefetch(prefetch):
+    def load(event, channels):
+        time.sleep(0.001)
+        return dict(event, pixels=channels)
+
+    partition = [dict(i=i) for i in range(20)]
+    out = _load_image_partition(partition, channels=[0], load=load, prefetch=prefetch)
+
+    assert [e["i"] for e in out] == list(range(20))
+    assert all(e["pixels"] == [0] for e in out)
+    if prefetch > 0:
+        assert prefetch_info()["events"] >= 20
+
+
+@pytest.mark.parametrize("native, dtype, expected", [
+    (2, "native", 2), (2, "float32", 4), (8, "native", 8), (8, "float32", 8)
+])
+def test_itemsize(native, dtype, expected):
+    assert itemsize(native, dtype) == expected
@@ -15,7 +15,9 @@
 # You should have received a copy of the GNU General Public License
 # along with SCIP.  If not, see <http://www.gnu.org/licenses/>.
 
-from scip.loading import zarr
+from scip.loading import zarr, auto_npartitions, sample_meta
+import zarr as zarr_module
+import numpy
 import pytest
 import dask.bag
 
@@ -29,3 +31,89 @@ def test_load_pixels(zarr_path, channels, expected_length):
 
     assert len(images) > 0
     assert all(len(im["pixels"]) == expected_length for im in images)
+
+
+@pytest.mark.parametrize("indices", [[0, 1, 2], [9, 3, 4, 0], [7], list(range(10))[::-1]])
+def test_load_image_partition(zarr_path, indices):
+    z = zarr_module.open(str(zarr_path), mode="r")
+    partition = [dict(path=str(zarr_path), zarr_idx=i) for i in indices]
+    partition = zarr.load_image_partition(partition, channels=[0, 1])
+
+    assert [p["zarr_idx"] for p in partition] == indices
+    for p in partition:
+        expected = z[p["zarr_idx"]].reshape(z.attrs["shape"][p["zarr_idx"]])[[0, 1]]
+        assert numpy.array_equal(p["pixels"], expected)
+
+
+@pytest.mark.parametrize("npartitions", [1, 2, 5])
+def test_repartition_chunk_aligned(zarr_path, npartitions):
+    z = zarr_module.open(str(zarr_path), mode="r")
+    images = zarr.meta_from_directory(path=zarr_path, regex="(?P<name>.*)")
+    images = dask.bag.from_delayed(images)
+    images = zarr.repartition(images, npartitions=npartitions)
+
+    assert images.npartitions == min(npartitions, z.nchunks)
+    for part in images.to_delayed():
+        indices = [e["zarr_idx"] for e in part.compute()]
+        assert indices[0] % z.chunks[0] == 0
+        assert (indices[-1] + 1) % z.chunks[0] == 0 or indices[-1] == z.shape[0] - 1
+
+
+def test_shape_index(zarr_path):
+    z = zarr_module.open(str(zarr_path), mode="r")
+    shapes = zarr._shape_index(str(zarr_path))
+
+    assert shapes.shape == (z.shape[0], 3)
+    assert numpy.array_equal(shapes, numpy.array(z.attrs["shape"]))
+    assert zarr._shape_index(str(zarr_path)) is shapes
+
+
+@pytest.mark.parametrize("channels", [None, [0, 1]])
+def test_estimate_nbytes(zarr_path, channels):
+    meta = zarr.meta_from_directory(path=zarr_path, regex="(?P<name>.*)")
+    partition = dask.bag.from_delayed(meta).compute()
+    images = zarr.load_image_partition(
+        partition, channels=numpy.s_[:] if channels is None else channels)
+
+    assert zarr.estimate_nbytes(partition, channels) == sum(im["pixels"].nbytes for im in images)
+
+
+@pytest.mark.parametrize("budget_fraction, min_npartitions, expected", [
+    (2, 1, 1), (0.5, 1, 2), (0.3, 1, 4), (0.3, 6, 6)
+])
+def test_auto_npartitions(zarr_path, budget_fraction, min_npartitions, expected):
+    meta = dask.bag.from_delayed(zarr.meta_from_directory(path=zarr_path, regex="(?P<name>.*)"))
+    nbytes = zarr.estimate_nbytes(meta.compute(), [0, 1])
+
+    npartitions = auto_npartitions(
+        bag=meta, channels=[0, 1], budget=int(nbytes * budget_fraction),
+        min_npartitions=min_npartitions, loader_module=zarr)
+
+    assert npartitions == expected
+
+
+@pytest.mark.parametrize(
+    "k, with_replacement, expected_n", [(3, False, 3), (100, False, 10), (20, True, 20)])
+def test_sample_meta(zarr_path, k, with_replacement, expected_n):
+    z = zarr_module.open(str(zarr_path), mode="r")
+    meta = dask.bag.from_delayed(zarr.meta_from_directory(path=zarr_path, regex="(?P<name>.*)"))
+    sampled = sample_meta(bag=meta, k=k, with_replacement=with_replacement, seed=0)
+
+    assert sampled.npartitions <= meta.npartitions
+    indices = [e["zarr_idx"] for e in sampled.compute()]
+    assert len(indices) == expected_n
+    if not with_replacement:
+        assert len(set(indices)) == expected_n
+
+    # sampled events stay in the partition of their chunk
+    for part in sampled.to_delayed():
+        assert len(set(e["zarr_idx"] // z.chunks[0] for e in part.compute())) == 1
+
+
+def test_estimate_nbytes_float32(zarr_path):
+    meta = zarr.meta_from_directory(path=zarr_path, regex="(?P<name>.*)")
+    partition = dask.bag.from_delayed(meta).compute()
+    images = zarr.load_image_partition(partition, channels=[0, 1])
+
+    nbytes = zarr.estimate_nbytes(partition, [0, 1], dtype="float32")
+    assert nbytes == sum(im["pixels"].astype(numpy.float32).nbytes for im in images)
@@ -15,14 +15,15 @@
 # You should have received a copy of the GNU General Public License
 # along with SCIP.  If not, see <http://www.gnu.org/licenses/>.
 
+import dask.bag
 from scip.loading import multiframe_tiff
 from scip.masking import li, bounding_box_partition, compute_filters
 
 
 def test_bounding_box(images_folder):
 
-    bag, _ = multiframe_tiff.bag_from_directory(
-        images_folder, channels=[0, 1, 2], partition_size=2)
+    bag = dask.bag.from_delayed(multiframe_tiff.meta_from_directory(images_folder))
+    bag = multiframe_tiff.load_pixels(bag.repartition(npartitions=6), channels=[0, 1, 2])
     bag = bag.map_partitions(
         compute_filters,
         config=[dict(
@@ -26,3 +26,12 @@ def test_filters(fake_images_bag, method, settings):
     assert len(images) > 0
     assert all("mask_filter" in im for im in images)
     assert all(len(im["mask_filter"]) == len(im["pixels"]) for im in images)
+
+
+@pytest.mark.parametrize("fake_images_bag", [False], indirect=True)
+def test_filters_leave_input_untouched(fake_images_bag):
+    partition = fake_images_bag.take(5)
+    images = compute_filters(partition, config=None, main_channel_index=0)
+
+    assert all("mask_filter" not in im for im in partition)
+    assert all(a["pixels"] is b["pixels"] for a, b in zip(partition, images))
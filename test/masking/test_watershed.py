@@ -0,0 +1,27 @@
+from scip.masking import watershed
+import numpy
+
+
+def test_watershed_keeps_pixels():
+    rng = numpy.random.default_rng(0)
+    pixels = rng.random((2, 32, 32)).astype(numpy.float32)
+    pixels[:, 8:24, 8:24] += 2
+    original = pixels.copy()
+
+    event = watershed.get_mask(dict(pixels=pixels), noisy_channels=[0])
+
+    assert event["mask"].shape == pixels.shape
+    assert event["pixels"] is pixels
+    assert numpy.array_equal(pixels, original)
+
+
+def test_watershed_integer_pixels():
+    rng = numpy.random.default_rng(0)
+    pixels = (rng.random((2, 32, 32)) * 100).astype(numpy.uint16)
+    pixels[:, 8:24, 8:24] += 1000
+
+    a = watershed.get_mask(dict(pixels=pixels), noisy_channels=[0])
+    b = watershed.get_mask(dict(pixels=pixels.astype(numpy.float32)), noisy_channels=[0])
+
+    assert a["mask"][0].any()
+    assert numpy.array_equal(a["mask"], b["mask"])
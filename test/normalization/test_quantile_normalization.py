@@ -41,6 +41,19 @@ def test_distributed_minmax(
         [expected_quantiles] * fake_image_nchannels))
 
 
+@pytest.mark.parametrize("dtype", [numpy.uint16, numpy.float32])
+def test_extremes_empty_mask(dtype):
+    pixels = numpy.arange(2 * 4 * 4, dtype=dtype).reshape(2, 4, 4)
+    mask = numpy.zeros_like(pixels, dtype=bool)
+    mask[0, 1:3, 1:3] = True
+
+    extent = quantile_normalization._extremes(pixels, mask)
+
+    assert numpy.array_equal(extent[0], [5, 10])
+    assert numpy.array_equal(extent[1], [numpy.inf, -numpy.inf])
+    assert numpy.array_equal(quantile_normalization._extremes(pixels)[1], [16, 31])
+
+
 @pytest.mark.parametrize("fake_images_bag", [True], indirect=["fake_images_bag"])
 def test_quantile_normalization(
     fake_images_bag,
@@ -48,9 +61,95 @@ def test_quantile_normalization(
 ):
 
     images, _ = quantile_normalization.quantile_normalization(
-        fake_images_bag, fake_image_nchannels)
+        fake_images_bag, 0, 1, fake_image_nchannels)
     images = images.compute()
 
     assert len(images) > 0
     assert all(max(1, im["pixels"].max()) == 1 for im in images)
     assert all(min(0, im["pixels"].min()) == 0 for im in images)
+
+
+@pytest.mark.parametrize("fake_images_bag", [False], indirect=["fake_images_bag"])
+def test_quantile_normalization_sketches(fake_images_bag, fake_image_nchannels, tmp_path):
+
+    images, quantiles = quantile_normalization.quantile_normalization(
+        fake_images_bag, 0.1, 0.9, fake_image_nchannels,
+        sketches_path=tmp_path / "sketches.npz")
+    images = images.compute()
+    quantiles = dict(quantiles.compute())
+
+    # each group holds five equal images, of which the masked pixels range from 22 to 77
+    masked = numpy.repeat(numpy.arange(100).reshape(10, 10)[2:8, 2:8].ravel(), 5)
+    expected = numpy.quantile(masked, [0.1, 0.9], method="lower")
+    for group in ["one", "two"]:
+        assert numpy.allclose(quantiles[group], [expected] * fake_image_nchannels, rtol=0.01)
+
+    assert len(images) > 0
+    assert (tmp_path / "sketches.npz").exists()
+
+
+@pytest.mark.parametrize("fake_images_bag", [False], indirect=["fake_images_bag"])
+def test_fit_transform(fake_images_bag, fake_image_nchannels, tmp_path):
+    path = tmp_path / "normalization.npz"
+
+    fitted, quantiles = quantile_normalization.quantile_normalization(
+        fake_images_bag, 0.1, 0.9, fake_image_nchannels, statistics_path=path)
+    fitted = fitted.compute()
+    quantiles = dict(quantiles.compute())
+    assert path.exists()
+
+    transformed, loaded = quantile_normalization.transform(fake_images_bag, path)
+    transformed = transformed.compute()
+    loaded = dict(loaded.compute())
+
+    assert loaded.keys() == quantiles.keys()
+    assert all(numpy.array_equal(loaded[k], quantiles[k]) for k in quantiles)
+    assert all(numpy.array_equal(a["pixels"], b["pixels"]) for a, b in zip(fitted, transformed))
+
+
+def test_transform_unknown_group(tmp_path):
+    path = tmp_path / "normalization.npz"
+    quantile_normalization.save_statistics([(None, numpy.array([[0., 1.]]))], path, 0, 1)
+    assert quantile_normalization.load_statistics(path)[0][0] is None
+
+    event = dict(pixels=numpy.zeros((1, 2, 2)), group="unknown")
+    with pytest.raises(ValueError):
+        quantile_normalization.sample_normalization(
+            event, quantile_normalization.bounds_lookup([(None, numpy.array([[0., 1.]]))]))
+
+
+@pytest.mark.parametrize("inplace", [True, False])
+@pytest.mark.parametrize("dtype", [numpy.uint16, numpy.float32])
+def test_sample_normalization_inplace(inplace, dtype):
+    pixels = numpy.arange(2 * 4 * 4, dtype=dtype).reshape(2, 4, 4).copy()
+    original = pixels.copy()
+    bounds = quantile_normalization.bounds_lookup([("a", numpy.array([[0., 15.], [16., 31.]]))])
+
+    event = quantile_normalization.sample_normalization(
+        dict(pixels=pixels, group="a"), bounds, inplace=inplace)
+
+    assert event["pixels"].dtype == numpy.float32
+    expected = numpy.tile(numpy.arange(16).reshape(4, 4) / 15, (2, 1, 1))
+    assert numpy.allclose(event["pixels"], expected)
+    shared = numpy.shares_memory(event["pixels"], pixels)
+    assert shared == (inplace and dtype == numpy.float32)
+    if not shared:
+        assert numpy.array_equal(pixels, original)
+
+
+def test_sample_normalization_inplace_views():
+    # cells cropped from one tile are views of which the bounding boxes can overlap
+    tile = numpy.arange(1 * 6 * 6, dtype=numpy.float32).reshape(1, 6, 6)
+    original = tile.copy()
+    bounds = quantile_normalization.bounds_lookup([("a", numpy.array([[0., 35.]]))])
+
+    events = [
+        quantile_normalization.sample_normalization(
+            dict(pixels=tile[:, :4, :4], group="a"), bounds, inplace=True),
+        quantile_normalization.sample_normalization(
+            dict(pixels=tile[:, 2:, 2:], group="a"), bounds, inplace=True)
+    ]
+
+    assert numpy.array_equal(tile, original)
+    assert numpy.allclose(events[0]["pixels"], original[:, :4, :4] / 35)
+    assert numpy.allclose(events[1]["pixels"], original[:, 2:, 2:] / 35)
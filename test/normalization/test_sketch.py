@@ -0,0 +1,66 @@
+# Copyright (C) 2022 Maxim Lippeveld
+#
+# This file is part of SCIP.
+#
+# SCIP is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SCIP is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with SCIP.  If not, see <http://www.gnu.org/licenses/>.
+
+from scip.normalization.sketch import QuantileSketch, save_sketches, load_sketches
+import numpy
+import pytest
+
+
+@pytest.fixture
+def values():
+    rng = numpy.random.default_rng(0)
+    return numpy.concatenate([rng.normal(100, 20, size=10000), [-5, 0, 0, 1e5]])
+
+
+@pytest.mark.parametrize("q", [0, 0.01, 0.25, 0.5, 0.99, 1])
+def test_quantile(values, q):
+    sketch = QuantileSketch(alpha=0.005).add(values)
+
+    assert sketch.count == len(values)
+    assert sketch.quantile(q) == pytest.approx(numpy.quantile(values, q), rel=0.01)
+
+
+def test_merge(values):
+    sketch = QuantileSketch().add(values)
+    merged = QuantileSketch().add(values[:3000]).merge(QuantileSketch().add(values[3000:]))
+
+    assert merged.count == sketch.count
+    for q in [0, 0.1, 0.5, 0.9, 1]:
+        assert merged.quantile(q) == sketch.quantile(q)
+
+
+def test_negative_values():
+    values = -numpy.arange(1, 1001, dtype=float)
+    sketch = QuantileSketch().add(values)
+
+    for q in [0.1, 0.5, 0.9]:
+        assert sketch.quantile(q) == pytest.approx(numpy.quantile(values, q), rel=0.01)
+
+
+def test_save_load(values, tmp_path):
+    sketches = {
+        "one": [QuantileSketch().add(values), QuantileSketch()],
+        2: [QuantileSketch()],
+        None: [QuantileSketch()]
+    }
+    save_sketches(sketches, tmp_path / "sketches.npz")
+    loaded = load_sketches(tmp_path / "sketches.npz")
+
+    assert set(loaded.keys()) == {"one", 2, None}
+    assert len(loaded["one"]) == 2
+    assert loaded["one"][0].quantile(0.5) == sketches["one"][0].quantile(0.5)
+    assert loaded["one"][1].count == 0
@@ -0,0 +1,74 @@
+# Copyright (C) 2022 Maxim Lippeveld
+#
+# This file is part of SCIP.
+#
+# SCIP is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# SCIP is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with SCIP.  If not, see <http://www.gnu.org/licenses/>.
+
+from scip.projection import focus
+import numpy
+import pytest
+from scipy.ndimage import gaussian_filter
+
+
+@pytest.fixture
+def stack():
+    # CZXY stack of which plane 3 is in focus, and planes further away are more blurred
+    rng = numpy.random.default_rng(0)
+    sharp = rng.integers(0, 1000, size=(2, 64, 64)).astype(numpy.uint16)
+    planes = [
+        gaussian_filter(sharp, sigma=(0, abs(z - 3), abs(z - 3))) for z in range(7)
+    ]
+    return numpy.stack(planes, axis=1)
+
+
+def test_project_block_best_plane(stack):
+    event = focus.project_block(dict(pixels=stack, path="a"), k=1, downscale=1)
+
+    assert event["path"] == "a"
+    assert event["pixels"].dtype == stack.dtype
+    assert numpy.array_equal(event["pixels"], stack[:, 3])
+
+
+@pytest.mark.parametrize("op", ["max", "mean"])
+def test_project_planes_best_k(stack, op):
+    pixels = focus.project_planes(
+        (stack[:, z] for z in range(stack.shape[1])), k=3, downscale=2, channel=0, op=op)
+
+    best = stack[:, 2:5]
+    expected = best.max(axis=1) if op == "max" else best.mean(axis=1, dtype=numpy.float32)
+    assert numpy.allclose(pixels, expected)
+
+
+def test_project_planes_per_tile(stack):
+    # tile 0 is in focus at plane 3, tile 1 at plane 5
+    other = numpy.roll(stack, 2, axis=1)
+    tiles = numpy.stack([stack, other], axis=0)
+
+    pixels = focus.project_planes((tiles[:, :, z] for z in range(7)), k=1, downscale=1)
+
+    assert pixels.shape == (2, 2, 64, 64)
+    assert numpy.array_equal(pixels[0], stack[:, 3])
+    assert numpy.array_equal(pixels[1], other[:, 5])
+
+
+def test_project_planes_levels(stack):
+    # the low resolution level is noise, so it is only in focus by selection on the first level
+    rng = numpy.random.default_rng(1)
+    lowres = rng.integers(0, 1000, size=(2, 7, 16, 16)).astype(numpy.uint16)
+
+    pixels, pixels_lowres = focus.project_planes(
+        ((stack[:, z], lowres[:, z]) for z in range(7)), k=1, downscale=1)
+
+    assert numpy.array_equal(pixels, stack[:, 3])
+    assert numpy.array_equal(pixels_lowres, lowres[:, 3])
@@ -1,3 +1,4 @@
+import pytest
 from click.testing import CliRunner
 from scip.main import cli
 import json
@@ -5,14 +6,15 @@ import pandas
 import pyarrow.parquet
 
 
-def test_cli(zarr_path, tmp_path, data):
+@pytest.mark.parametrize("n_partitions", ["5", "auto"])
+def test_cli(zarr_path, tmp_path, data, n_partitions):
     runner = CliRunner()
     result = runner.invoke(cli, [
         "--mode", "local",
         "--headless",
         "--n-workers", "4",
         "--n-threads", "1",
-        "--n-partitions", "5",
+        "--n-partitions", n_partitions,
         "--timing", str(tmp_path / "timing.json"),
         str(tmp_path),
         str(data / "scip_zarr.yml"),
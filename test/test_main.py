@@ -78,4 +78,4 @@ def test_main_with_correction(tiffs_folder, tmp_path, data):
         [pyarrow.parquet.read_table(f).to_pandas() for f in tmp_path.glob("*.parquet")], axis=0)
     assert len(df) > 0
 
-    assert (tmp_path / "correction_images.pickle").exists()
+    assert len(list((tmp_path / "correction_images").glob("*.npy"))) > 0
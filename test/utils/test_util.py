@@ -0,0 +1,48 @@
+import numpy
+import pytest
+from scip.utils.util import enforce_dtype
+
+
+@pytest.mark.parametrize(
+    "dtype, pixels_dtype, expected",
+    [
+        ("native", numpy.uint16, numpy.uint16),
+        ("native", numpy.float32, numpy.float32),
+        ("native", numpy.float64, numpy.float32),
+        ("float32", numpy.uint16, numpy.float32),
+        ("float32", numpy.float64, numpy.float32),
+    ]
+)
+def test_enforce_dtype(dtype, pixels_dtype, expected):
+    event = dict(pixels=numpy.arange(12, dtype=pixels_dtype).reshape(3, 2, 2))
+    newevent = enforce_dtype(event, dtype)
+
+    assert newevent["pixels"].dtype == expected
+    assert numpy.array_equal(newevent["pixels"], event["pixels"])
+    if pixels_dtype == expected:
+        assert newevent is event
+
+
+def test_enforce_dtype_without_pixels():
+    event = dict(path="a")
+    assert enforce_dtype(event, "float32") is event
+
+
+def test_lowres_roundtrip():
+    from scip.utils.util import to_lowres, to_fullres
+
+    pixels = numpy.zeros((2, 8, 8), dtype=numpy.uint16)
+    event = dict(pixels=pixels, pixels_lowres=pixels[:, ::4, ::4])
+
+    lowres = to_lowres(event)
+    assert lowres["pixels"].shape == (2, 2, 2)
+
+    lowres["mask"] = numpy.array([[[1, 0], [0, 2]]] * 2, dtype=numpy.int32)
+    fullres = to_fullres(lowres)
+
+    assert fullres["pixels"] is pixels
+    assert "pixels_fullres" not in fullres
+    assert fullres["mask"].dtype == numpy.int32
+    assert fullres["mask"].shape == (2, 8, 8)
+    assert numpy.array_equal(numpy.unique(fullres["mask"]), [0, 1, 2])
+    assert (fullres["mask"][:, :4, :4] == 1).all()